@@ -17,6 +17,7 @@ from constants import VERSION
 from collections import defaultdict
 from lib.get_platform import *
 from lib.vlcclient import get_default_vlc_path
+from lib.broadcast import ClientChannel
 
 try:
 	from urllib.parse import quote, unquote
@@ -28,6 +29,8 @@ app.config['TEMPLATES_AUTO_RELOAD'] = True	##DEBUG
 app.secret_key = os.urandom(24)
 admin_password = K = args = None
 sock = Sock(app)
+ip2queue_ver = {}   # queue version last sent to each client on the queue pane
+STATUS_RESYNC_SEC = 10  # while playing, re-read the position from VLC to correct the clients' interpolation
 os.texts = defaultdict(lambda: "")
 getString = lambda ii: os.texts[ii]
 getString1 = lambda lang, ii: os.langs[lang].get(ii, os.langs['en_US'][ii])
@@ -38,56 +41,67 @@ getString2 = lambda ii: getString1(request.client_lang, ii)
 @sock.route('/ws_init')
 def ws_init(sock):
 	key = sock.sock.getpeername()[0]
-	ip2websock[key] = sock
-	while sock.connected:
+	# a reconnecting client replaces its old channel, which must not evict the new one when it closes
+	ch = ip2websock[key] = ClientChannel(sock, lambda ch: ip2websock.pop(key) if ip2websock.get(key) is ch else None)
+	while ch.connected:
 		try:
 			cmd = sock.receive()
 			wscmd(key, cmd)
 		except:
 			traceback.print_exc()
-	ip2websock.pop(key)
+	ch.close()
 
 def wscmd(client_ip, cmd):
-	if cmd.startswith('pop_from_queue '):
+	if cmd == 'queue_resync':
+		ip2queue_ver.pop(client_ip, None)
+		K.publish('queue')
+	elif cmd.startswith('pop_from_queue '):
 		name = cmd.split(' ', 1)[1]
 		K.queue_edit(name, 'delete')
 	elif cmd.startswith('addsongs '):
 		lst = cmd[9:].split('\t')
-		for fn in lst[1:]:
-			K.enqueue(fn, lst[0])
+		K.enqueue_songs(lst[1:], lst[0])
+
+def send_queue(ip, ws):
+	# deltas since the version this client last received, a full snapshot if it is too far behind
+	ops, version = K.queue.ops_since(ip2queue_ver.get(ip))
+	if ops is None:
+		queue_json = K.queue_json
+		version = K.queue_json_cache[0]
+		ws.send(f"update('{queue_json}', {version})")
+	elif ops:
+		ws.send(f"update_delta({json.dumps(ops)}, {ip2queue_ver[ip]}, {version})")
+	ip2queue_ver[ip] = version
 
 def status_thread():
+	# pushes state changes published by Karaoke, clients interpolate the seek position in between
 	cached_status = ''
 	while True:
-		K.event_dirty.wait(1)
-
-		status = nowplaying(False)
-		if not status: continue
-
-		status_full = json.dumps(status)
-		status.pop('seektrack_value', None)
-		status_str = json.dumps(status)
-		if status_str != cached_status:
-			K.status_dirty = True
-			cached_status = status_str
-
-		if not K.status_dirty:
-			if not K.is_file_playing():
-				continue
-			tm = K.get_state().get('time', None)
-			if tm is None:
-				continue
-			for ip, ws in ip2websock.items():
-				if ip2pane.get(ip, '') == 'home':
-					ws.send(f"seektrack.value={tm};$('#seektrack-val').text(getHHMMSS({tm}));")
-			continue
-
-		for ip, ws in ip2websock.items():
+		woken = K.event_dirty.wait(STATUS_RESYNC_SEC if K.is_file_playing() else None)
+		events = K.pop_events() if woken else {'seek'}
+
+		# queue changes are included, up_next/next_user come from the queue head
+		status, tm = nowplaying(False), None
+		if status:
+			tm = status.pop('seektrack_value', None)
+			status_str = json.dumps(status)
+			if status_str != cached_status:
+				events.add('status')
+				cached_status = status_str
+			status['seektrack_value'] = tm
+			status_full = json.dumps(status)
+
+		for ip, ws in list(ip2websock.items()):
 			if ip2pane.get(ip, '') == 'home':
-				ws.send(f"update('{status_full}')")
+				# no status while switching songs, the next wakeup catches up
+				if not status:
+					continue
+				if 'status' in events:
+					ws.send(f"update('{status_full}')", 'status')
+				elif 'seek' in events and tm is not None:
+					ws.send(f"seek_update({tm})", 'seek')
 			elif ip2pane.get(ip, '') == 'queue':
-				ws.send(f"update('{K.queue_json}')")
-		K.status_dirty = False
+				send_queue(ip, ws)
 
 # Define global symbols for Jinja templates 
 @app.context_processor
@@ -216,6 +230,12 @@ def nowplaying(return_json=True):
 		return "" if return_json else {}
 
 
+@app.route("/vlc_stats")
+def vlc_stats():
+	# per-command round-trip latency of VLC's HTTP interface
+	return json.dumps(K.vlcclient.get_latency_stats() if K.use_vlc else {})
+
+
 @app.route("/get_lang_list")
 def get_lang_list():
 	return json.dumps({k: v[1] for k, v in os.langs.items()}, sort_keys = False)
@@ -270,10 +290,11 @@ def user_rename(old_name, new_name):
 	for q in K.queue:
 		if q['user'] == old_name:
 			q['user'] = new_name
+			K.queue.touch(q)
 			dirty = True
 	if K.now_playing_user == old_name:
 		K.now_playing_user = new_name
-		K.status_dirty = True
+		K.publish()
 	if dirty:
 		K.update_queue()
 	return ''
@@ -282,14 +303,25 @@ def user_rename(old_name, new_name):
 @app.route("/get_vocal_todo_list/<vocal_device>/")
 @app.route("/get_vocal_todo_list/<vocal_device>/<path:last_completed>")
 def get_vocal_todo_list(vocal_device, last_completed=''):
+	# the splitter calls this once at startup for the download path, jobs then come from K.vocal_jobs
 	K.vocal_device = vocal_device
-	if last_completed in K.rename_history:
-		K.rename(last_completed, os.path.splitext(K.rename_history[last_completed])[0])
-		K.rename_history.pop(last_completed)
+	vocal_job_done(vocal_device, last_completed)
 	q = ([K.now_playing_filename] if K.now_playing_filename else []) + [i['file'] for i in K.queue]
 	return json.dumps({'download_path': K.download_path, 'queue': q, 'use_DNN': K.use_DNN_vocal})
 
 
+@app.route("/vocal_job_done/<vocal_device>/<path:basename>")
+def vocal_job_done(vocal_device, basename):
+	K.vocal_device = vocal_device
+	if basename in K.rename_history:
+		K.rename(basename, os.path.splitext(K.rename_history[basename])[0])
+		K.rename_history.pop(basename)
+	if K.now_playing_filename and basename == os.path.basename(K.now_playing_filename):
+		K.get_vocal_info(True)
+		K.publish()
+	return ''
+
+
 @app.route("/save_delays/<state>")
 def set_save_delays(state):
 	K.set_save_delays(state.lower() == 'true')
@@ -298,7 +330,7 @@ def set_save_delays(state):
 
 @app.route("/set_vocal_mode/<mode>")
 def set_vocal_mode(mode):
-	K.use_DNN_vocal = (mode.lower() == 'true')
+	K.set_vocal_split_mode(mode.lower() == 'true')
 	K.play_vocal()
 	return ''
 
@@ -315,6 +347,7 @@ def queue():
 @app.route("/f_queue")
 def f_queue():
 	ip2pane[request.remote_addr] = 'queue'
+	ip2queue_ver.pop(request.remote_addr, None)
 	return render_template("f_queue.html", getString1 = lambda ii: getString1(request.client_lang, ii), queue = K.queue, admin = is_admin())
 
 
@@ -506,11 +539,8 @@ def f_search():
 
 @app.route("/autocomplete")
 def autocomplete():
-	q = request.args.get('q').lower()
-	result = []
-	for each in K.available_songs:
-		if q in each.lower():
-			result.append({"path": each, "fileName": K.filename_from_path(each), "type": "autocomplete"})
+	q = request.args.get('q')
+	result = [{"path": each, "fileName": K.filename_from_path(each), "type": "autocomplete"} for each in K.library.search(q)]
 	response = app.response_class(
 		response = json.dumps(result),
 		mimetype = 'application/json'
@@ -520,8 +550,9 @@ def autocomplete():
 
 @app.route("/suggest")
 def suggest():
-	q = request.args.get('q').lower()
-	res = {K.filename_from_path(s):s for s in K.available_songs if q in s.lower()}
+	q = request.args.get('q')
+	# runs on every keystroke, the fuzzy pass is only worth it when the exact matches have (nearly) run out
+	res = {K.filename_from_path(s):s for s in K.library.search(q, fuzzy = 3)}
 	return json.dumps(res)
 
 
@@ -846,7 +877,7 @@ def _add_spoken(client_ip, user, getString):
 	elif not asr_output['text']:
 		return logging.error(f'ASR output is empty')
 
-	res = findMedia(K.download_path, asr_output['text'], lang=asr_output['language'])
+	res = findMedia(K.download_path, asr_output['text'], lang=asr_output['language'], index=K.phonetic)
 	ws = ip2websock.get(client_ip, '')
 	if not res:
 		return ws.send(f"showNotification('{getString(226)%asr_output['text']}', 'is-info')")
@@ -1058,6 +1089,12 @@ if __name__ == "__main__":
 		help = "Enable volume normalization",
 		action = 'store_true',
 	)
+	parser.add_argument(
+		"--loudness-workers",
+		help = "Number of background workers analysing song loudness for volume normalization, queued songs go first (default: 1)",
+		type = int,
+		default = 1,
+	)
 	parser.add_argument(
 		"-s", "--splash-delay",
 		help = f"Delay during splash screen between songs (in secs). (default: {default_splash_delay} )",
@@ -1127,6 +1164,24 @@ if __name__ == "__main__":
 		help = f"HTTP port for VLC remote control api (Default: {default_vlc_port})",
 		default = default_vlc_port,
 	)
+	parser.add_argument(
+		"--vlc-control",
+		help = "How to control VLC: http (status.xml polling) or rc (persistent RC socket, HTTP is kept for stream info). "
+		       "Only rc switches audio/subtitle tracks without restarting the song. (Default: rc with --vlc-standby, http otherwise)",
+		choices = ['http', 'rc'],
+		default = None,
+	)
+	parser.add_argument(
+		"--transpose-cache-mb",
+		help = "Size limit (in MB) of the cache of pre-rendered pitch-shifted audio for transposed playback, 0 disables it and transposes in real time (Default: 0)",
+		type = int,
+		default = 0,
+	)
+	parser.add_argument(
+		"--vlc-standby",
+		action = "store_true",
+		help = "Keep one VLC process running and switch songs through its playlist, the next song is enqueued during the splash screen",
+	)
 	parser.add_argument(
 		"--logo-path",
 		help = "Path to a custom logo image file for the splash screen. Recommended dimensions ~ 500x500px",
@@ -16,6 +16,12 @@ from bidi.algorithm import get_display
 from unidecode import unidecode
 from flask import request
 from lib import omxclient, vlcclient
+from lib.library import SongLibrary
+from lib.songqueue import SongQueue
+from lib.transpose import TransposeCache
+from lib import loudness
+from lib.volstore import VolumeStore
+from lib.vocaljobs import VocalJobQueue, missing_outputs, partial_paths, partial_ready, NOW_PLAYING, QUEUED, BACKFILL
 from lib.get_platform import *
 from lib.NLP import *
 from app import getString
@@ -45,8 +51,8 @@ def cleanse_modules(name):
 class Karaoke:
 	ref_W, ref_H = 1920, 1080      # reference screen size, control drawing scale
 
-	queue = []
-	queue_json = ''
+	queue = SongQueue()
+	queue_json_cache = (None, '')
 	available_songs = []
 	rename_history = {}
 	songname_trans = {} # transliteration is used for sorting and initial letter search
@@ -55,6 +61,9 @@ class Karaoke:
 	now_playing_user = None
 	now_playing_transpose = 0
 	now_playing_slave = ''
+	now_playing_slaves = []
+	switch_target = 0.3	# seconds, in-place track switches slower than this are logged
+	transpose_lookahead = 2	# queued songs to pre-render transposed variants for
 	audio_delay = 0
 	has_video = True
 	has_subtitle = False
@@ -67,6 +76,7 @@ class Karaoke:
 	vocal_process = None
 	vocal_device = None
 	vocal_mode = 'mixed'
+	partial_lead_sec = 15	# seconds a track still being separated must be ahead of the playhead to be played
 	is_paused = True
 	firstSongStarted = False
 	switchingSong = False
@@ -75,10 +85,11 @@ class Karaoke:
 	volume_offset = 0
 	default_logo_path = os.path.join(base_path, "logo.jpg")
 	logical_volume = None   # for normalized volume
-	status_dirty = True
 	event_dirty = threading.Event()
+	pending_events = set()  # 'status', 'seek' and/or 'queue', consumed by the status thread in app.py
 
 	def __init__(self, args):
+		init_time = time.time()
 
 		# override with supplied constructor args if provided
 		self.__dict__.update(args.__dict__)
@@ -94,6 +105,7 @@ class Karaoke:
 		self.screen = None
 		self.player_state = {}
 		self.downloading_songs = {}
+		self.queue = SongQueue()
 		self.log_level = int(args.log_level)
 
 		logging.basicConfig(
@@ -128,9 +140,33 @@ class Karaoke:
 		self.url = "%s://%s:%s" % (('https' if self.ssl else 'http'), self.ip, self.port)
 
 		# get songs from download_path
+		tm = time.time()
+		self.library = SongLibrary(self.download_path, media_types, self.filename_from_path, self.download_path+'.songs_catalogue.json.gz')
+		self.available_songs = self.library.songs
+		self.songname_trans = self.library.sorted_trans
 		self.get_available_songs()
+		self.startup_times = {'library': time.time()-tm}
+		# databases live in a subdirectory, their -wal/-shm files would otherwise change the mtime that the library scan relies on
+		self.state_path = self.download_path + '.state/'
+		os.makedirs(self.state_path, exist_ok=True)
+		self.phonetic = PhoneticIndex(self.download_path+'.phonetic_keys.json.gz')
+		self.library.listeners.append(lambda new, gone: threading.Thread(target=self.phonetic.update, args=(new, gone), daemon=True).start())
+		threading.Thread(target=self.phonetic.sync, args=(list(self.available_songs),), daemon=True).start()
+		self.transpose_cache = None
+		if self.transpose_cache_mb and shutil.which('ffmpeg'):
+			self.transpose_cache = TransposeCache(self.download_path+'.transposed/', self.transpose_cache_mb*2**20)
+		tm = time.time()
 		self.get_youtubedl_version()
-		self.song2vol = Try(lambda: json.load(Open(self.download_path+'/.mp3_volume.json.gz')), {})
+		self.startup_times['yt-dlp'] = time.time()-tm
+		tm = time.time()
+		self.volume_store = VolumeStore(self.state_file('mp3_volume.db'), self.download_path+'.mp3_volume.json.gz')
+		self.loudness_worker = loudness.LoudnessWorker(self.analyse_mp3_volume, self.loudness_workers)
+		self.library.listeners.append(lambda new, gone: self.normalize_vol and self.loudness_worker.request(new, 1))
+		self.schedule_loudness()
+		self.startup_times['volume cache'] = time.time()-tm
+		self.vocal_jobs = VocalJobQueue(self.state_file('vocal_jobs.db'))
+		self.library.listeners.append(lambda new, gone: self.push_vocal_jobs(new, BACKFILL))
+		threading.Thread(target=self.push_vocal_jobs, args=(list(self.available_songs), BACKFILL), daemon=True).start()
 		
 		# Automatically upgrade yt-dlp if using pip
 		if not args.youtubedl_path:
@@ -141,8 +177,11 @@ class Karaoke:
 
 		self.generate_qr_code()
 		if self.use_vlc:
-			self.vlcclient = vlcclient.VLCClient(port = self.vlc_port, path = self.vlc_path,
-			                                     qrcode = (self.qr_code_path if self.show_overlay else None), url = self.url)
+			# standby VLC defaults to RC control, which can switch audio/subtitle tracks without reopening the song
+			self.vlc_control = self.vlc_control or ('rc' if self.vlc_standby else 'http')
+			VLC = vlcclient.VLCRCClient if self.vlc_control == 'rc' else vlcclient.VLCClient
+			self.vlcclient = VLC(port = self.vlc_port, path = self.vlc_path, standby = self.vlc_standby,
+			                     qrcode = (self.qr_code_path if self.show_overlay else None), url = self.url)
 		else:
 			self.omxclient = omxclient.OMXClient(path = self.omxplayer_path, adev = self.omxplayer_adev,
 			                                     dual_screen = self.dual_screen, volume_offset = self.volume_offset)
@@ -151,12 +190,20 @@ class Karaoke:
 			self.initialize_screen(not args.windowed)
 			self.render_splash_screen()
 
+		if self.use_vlc and self.vlc_standby:
+			tm = time.time()
+			self.vlcclient.start_standby(self.vlc_drawable_params())
+			self.startup_times['VLC standby'] = time.time()-tm
+
 		self.cloud = args.cloud
 		if args.cloud:
 			self.cloud_trigger = threading.Event()
 			self.cloud_tasks = []
 			threading.Thread(target=self._cloud_thread).start()
 
+		self.startup_times['total'] = time.time()-init_time
+		logging.info("Startup timing: " + ', '.join(f'{k} {v:.3f}s' for k, v in self.startup_times.items()))
+
 	def _upgrade_yt_dlp(self):
 		import pip, yt_dlp
 		fn = '.yt-dlp.last-update'
@@ -504,7 +551,7 @@ class Karaoke:
 			bn = self.get_downloaded_file_basename(song_url)
 			if bn:
 				shutil.move(self.download_path+'tmp/'+bn, self.download_path+bn)
-				self.get_available_songs()
+				self.library.add(self.download_path+bn)
 				if enqueue:
 					self.enqueue(self.download_path+bn, song_added_by)
 					self.downloading_songs[song_url] = '00'
@@ -523,21 +570,7 @@ class Karaoke:
 
 	def get_available_songs(self):
 		logging.info("Fetching available songs in: " + self.download_path)
-		files_grabbed = []
-		self.songname_trans = {}
-		for bn in os.listdir(self.download_path):
-			fn = self.download_path + bn
-			if not bn.startswith('.') and os.path.isfile(fn):
-				if os.path.splitext(fn)[1].lower() in media_types:
-					files_grabbed.append(fn)
-					trans = unidecode(self.filename_from_path(fn)).lower()
-					# strip leading non-transliterable symbols
-					while trans and not trans[0].islower() and not trans[0].isdigit():
-						trans = trans[1:]
-					self.songname_trans[fn] = trans
-
-		# self.available_songs = sorted(files_grabbed, key = lambda f: str.lower(os.path.basename(f)))
-		self.available_songs = sorted(self.songname_trans, key = self.songname_trans.get)
+		self.library.scan()
 
 	def get_all_assoc_files(self, song_path):
 		basename = os.path.basename(song_path)
@@ -563,7 +596,7 @@ class Karaoke:
 		for fn in self.get_all_assoc_files(song_path):
 			self.delete_if_exist(fn)
 
-		self.get_available_songs()
+		self.library.remove(song_path)
 
 	def rename_if_exist(self, old_path, new_path):
 		if os.path.isfile(old_path):
@@ -586,18 +619,24 @@ class Karaoke:
 			if v == old_basename:
 				self.rename_history[k] = new_basename
 
+		self.vocal_jobs.rename(old_basename, new_basename)
+
 		# rename all associated cdg/vocal/nonvocal files if exist
 		for src, tgt in zip(self.get_all_assoc_files(song_path), self.get_all_assoc_files(new_basename)):
 			self.rename_if_exist(src, tgt)
 
 		# rename queue entry if inside queue
-		for item in self.queue:
-			if item['file'] == song_path:
-				item['file'] = self.download_path + new_basename
-				item['title'] = self.filename_from_path(item['file'])
-				break
+		self.queue.rename(song_path, self.download_path + new_basename, self.filename_from_path(new_basename))
 
-		self.get_available_songs()
+		self.library.rename(song_path, self.download_path + new_basename)
+
+	def state_file(self, name):
+		# moves a database from its old place at the top of download_path
+		fn, old = self.state_path + name, self.download_path + '.' + name
+		if os.path.isfile(old) and not os.path.exists(fn):
+			for ext in ['', '-wal', '-shm']:
+				self.rename_if_exist(old+ext, fn+ext)
+		return fn
 
 	def filename_from_path(self, file_path):
 		rc = os.path.basename(file_path)
@@ -613,42 +652,82 @@ class Karaoke:
 		elif self.omxclient != None:
 				self.omxclient.kill()
 
+	def song_delays(self, file_path):
+		# (audio_delay, subtitle_delay, show_subtitle) for a song about to start, falling back to its saved delays
+		saved = self.delays.get(os.path.basename(file_path), {}) if self.save_delays else {}
+		return (self.audio_delay if self.audio_delay else saved.get('audio_delay', 0),
+		        self.subtitle_delay if self.subtitle_delay else saved.get('subtitle_delay', 0),
+		        False if self.show_subtitle==False else saved.get('show_subtitle', True))
+
+	def vlc_drawable_params(self):
+		if self.platform == 'osx':
+			return []
+		return ['--drawable-hwnd' if self.platform == 'windows' else '--drawable-xid', hex(pygame.display.get_wm_info()['window'])]
+
+	def vocal_slaves(self, file_path):
+		bn = ('' if self.use_DNN_vocal else '.') + os.path.basename(file_path) + '.m4a'
+		return [fn for fn in [self.download_path+'nonvocal/'+bn, self.download_path+'vocal/'+bn] if os.path.isfile(fn)]
+
+	def vlc_song_params(self, file_path, delays, transpose = 0, start_time = 0):
+		# returns (per-song VLC options, vocal mode, selected vocal/nonvocal slave track, all slave tracks, whether transposed)
+		audio_delay, subtitle_delay, show_subtitle = delays
+		params = []
+		mode, play_slave = self.vocal_track(self.vocal_mode, file_path, start_time)
+		# all separated tracks are opened as slaves, so that play_vocal only has to switch the audio track
+		slaves = self.vocal_slaves(file_path)
+		if play_slave and play_slave not in slaves:
+			slaves += [play_slave]
+		if any('#' in fn for fn in slaves):
+			slaves = [play_slave] if play_slave else []	# '#' separates the slaves
+		# a pre-rendered pitch-shifted variant replaces the live scaletempo_pitch filter
+		variant = transpose and self.transpose_cache and self.transpose_cache.lookup(play_slave or file_path, transpose)
+		selected = play_slave
+		if variant and '#' not in variant:
+			slaves, selected = [variant], variant
+		if slaves:
+			params += ['--input-slave=' + '#'.join(slaves), f'--audio-track={slaves.index(selected)+1 if selected else 0}']
+		if audio_delay:
+			params += [f'--audio-desync={audio_delay * 1000}']
+		if subtitle_delay:
+			params += [f'--sub-delay={subtitle_delay * 10}']
+		if show_subtitle:
+			params += [f'--sub-track=0']
+		if self.play_speed != 1:
+			params += [f'--rate={self.play_speed}']
+		return params, mode, play_slave, slaves, bool(variant)
+
+	def preload_next(self):
+		# standby VLC only: enqueue the queue head while the splash screen is shown
+		if self.use_vlc and self.vlc_standby and self.queue:
+			file_path = self.queue[0]['file']
+			params = self.vlc_song_params(file_path, self.song_delays(file_path))[0]
+			Try(lambda: self.vlcclient.preload(file_path, params))
+
 	def play_file(self, file_path, extra_params = []):
 		self.switchingSong = True
 		if self.use_vlc:
-			if self.save_delays:
-				saved_delays = self.delays.get(os.path.basename(file_path), {})
-				self.audio_delay = self.audio_delay if self.audio_delay else saved_delays.get('audio_delay', 0)
-				self.subtitle_delay = self.subtitle_delay if self.subtitle_delay else saved_delays.get('subtitle_delay', 0)
-				self.show_subtitle = False if self.show_subtitle==False else saved_delays.get('show_subtitle', True)
-			extra_params1 = []
+			self.audio_delay, self.subtitle_delay, self.show_subtitle = self.song_delays(file_path)
 			logging.info("Playing video in VLC: " + file_path)
-			if self.platform != 'osx':
-				extra_params1 += ['--drawable-hwnd' if self.platform == 'windows' else '--drawable-xid',
-				                  hex(pygame.display.get_wm_info()['window'])]
-			self.now_playing_slave = self.try_set_vocal_mode(self.vocal_mode, file_path)
-			if os.path.isfile(self.now_playing_slave):
-				extra_params1 += [f'--input-slave={self.now_playing_slave}', '--audio-track=1']
-			if self.audio_delay:
-				extra_params1 += [f'--audio-desync={self.audio_delay * 1000}']
-			if self.subtitle_delay:
-				extra_params1 += [f'--sub-delay={self.subtitle_delay * 10}']
-			if self.show_subtitle:
-				extra_params1 += [f'--sub-track=0']
-			if self.play_speed != 1:
-				extra_params1 += [f'--rate={self.play_speed}']
+			# a partial vocal/nonvocal track has to be ahead of where playback restarts, not of the song start
+			start_time = next((float(p.split('=', 1)[1]) for p in extra_params if p.startswith('--start-time=')), 0)
+			extra_params1, self.vocal_mode, self.now_playing_slave, self.now_playing_slaves, transposed = \
+				self.vlc_song_params(file_path, (self.audio_delay, self.subtitle_delay, self.show_subtitle), self.now_playing_transpose, start_time)
+			if not self.vlc_standby:
+				extra_params1 = self.vlc_drawable_params() + extra_params1
 			self.now_playing = self.filename_from_path(file_path)
 			self.now_playing_filename = file_path
 			self.is_paused = ('--start-paused' in extra_params1)
 			if self.normalize_vol and self.logical_volume is not None:
 				self.volume = self.logical_volume / np.sqrt(self.get_mp3_volume(file_path))
-			if self.now_playing_transpose == 0:
+			if self.now_playing_transpose == 0 or transposed:
 				xml = self.vlcclient.play_file(file_path, self.volume, extra_params + extra_params1)
 			else:
 				xml = self.vlcclient.play_file_transpose(file_path, self.now_playing_transpose, self.volume, extra_params + extra_params1)
-			self.has_subtitle = "<info name='Type'>Subtitle</info>" in xml
-			self.has_video = "<info name='Type'>Video</info>" in xml
-			self.volume = round(float(self.vlcclient.get_val_xml(xml, 'volume')))
+			status = self.vlcclient.parse(xml)
+			self.has_subtitle = status.has_subtitle
+			self.has_video = status.has_video
+			if status.volume is not None:
+				self.volume = round(status.volume)
 			if self.normalize_vol:
 				self.media_vol = self.get_mp3_volume(self.now_playing_filename)
 				self.logical_volume = self.volume * np.sqrt(self.media_vol)
@@ -657,16 +736,39 @@ class Karaoke:
 			self.omxclient.play_file(file_path)
 
 		self.switchingSong = False
-		self.status_dirty = True
+		self.publish()
 		self.render_splash_screen()  # remove old previous track
 
+	def restart_at_position(self):
+		# reopens the current song where it is, for changes VLC cannot apply to running media
+		tm = time.time()
+		status_xml = self.vlcclient.command().text if self.is_paused else self.vlcclient.pause(False).text
+		info = self.vlcclient.get_info_xml(status_xml)
+		posi = info['position']*info['length']
+		self.play_file(self.now_playing_filename, [f'--start-time={posi}'] + (['--start-paused'] if self.is_paused else []))
+		self.vlcclient.record_latency('switch by restart', time.time()-tm)
+
+	def switch_track(self, kind, pick):
+		# switches a stream of the running media, pick maps the available ES ids to the one to use (or None);
+		# False if the track cannot be switched in place, e.g. over HTTP, callers then restart the song
+		if not self.vlcclient.tracks_verifiable:
+			return False
+		tm = time.time()
+		es_id = pick(self.vlcclient.stream_ids(kind))
+		if es_id is None or not self.vlcclient.set_track(kind, es_id):
+			return False
+		tm = time.time()-tm
+		self.vlcclient.record_latency('switch', tm)
+		if tm > self.switch_target:
+			logging.warning(f"Switching {kind} track took {tm:.3f}s, target is {self.switch_target}s")
+		self.publish()
+		return True
+
 	def play_transposed(self, semitones):
 		if self.use_vlc:
+			# neither the HTTP nor the RC interface can change pitch-shift on running media
 			self.now_playing_transpose = semitones
-			status_xml = self.vlcclient.command().text if self.is_paused else self.vlcclient.pause(False).text
-			info = self.vlcclient.get_info_xml(status_xml)
-			posi = info['position']*info['length']
-			self.play_file(self.now_playing_filename, [f'--start-time={posi}'] + (['--start-paused'] if self.is_paused else []))
+			self.restart_at_position()
 		else:
 			logging.error("Not using VLC. Can't transpose track.")
 
@@ -679,7 +781,7 @@ class Karaoke:
 		return False
 
 	def is_song_in_queue(self, song_path):
-		return song_path in map(lambda t: t['file'], self.queue)
+		return self.queue.has(song_path)
 
 	def enqueue(self, song_path, user = "Pikaraoke"):
 		if (self.is_song_in_queue(song_path)):
@@ -691,35 +793,83 @@ class Karaoke:
 			self.update_queue()
 			return True
 
+	def enqueue_songs(self, song_paths, user = "Pikaraoke"):
+		new_paths = []
+		for song_path in song_paths:
+			if self.is_song_in_queue(song_path) or song_path in new_paths:
+				logging.warn("Song is already in queue, will not add: " + song_path)
+			else:
+				new_paths.append(song_path)
+		if new_paths:
+			logging.info("'%s' is adding %d songs to queue" % (user, len(new_paths)))
+			self.queue.extend({"user": user, "file": fn, "title": self.filename_from_path(fn)} for fn in new_paths)
+			self.update_queue()
+		return len(new_paths)
+
 	def queue_add_random(self, amount):
 		logging.info("Adding %d random songs to queue" % amount)
-		songs = list(self.available_songs)  # make a copy
-		if len(songs) == 0:
+		if len(self.available_songs) == 0:
 			logging.warn("No available songs!")
 			return False
-		i = 0
-		while i < amount:
-			r = random.randint(0, len(songs) - 1)
-			if self.is_song_in_queue(songs[r]):
-				logging.warn("Song already in queue, trying another... " + songs[r])
-			else:
-				self.queue.append({"user": "Random", "file": songs[r], "title": self.filename_from_path(songs[r])})
-				i += 1
-			songs.pop(r)
-			if len(songs) == 0:
-				self.update_queue()
-				logging.warn("Ran out of songs!")
-				return False
+		songs = [s for s in self.available_songs if not self.is_song_in_queue(s)]
+		picked = random.sample(songs, min(amount, len(songs)))
+		self.queue.extend({"user": "Random", "file": s, "title": self.filename_from_path(s)} for s in picked)
 		self.update_queue()
+		if len(picked) < amount:
+			logging.warn("Ran out of songs!")
+			return False
 		return True
 
+	@property
+	def queue_json(self):
+		# serialised on demand, clients on the queue pane normally receive deltas instead
+		if self.queue_json_cache[0] != self.queue.version:
+			self.queue_json_cache = (self.queue.version, json.dumps(self.queue))
+		return self.queue_json_cache[1]
+
 	def update_queue(self):
-		self.queue_json = json.dumps(self.queue)
-		self.status_dirty = True
+		self.publish('queue')
+		self.schedule_vocal_jobs()
+		self.prefetch_transposed()
+		if self.normalize_vol:
+			self.loudness_worker.request([e['file'] for e in self.queue], 0)
+
+	def push_vocal_jobs(self, files, priority):
+		self.vocal_jobs.push(missing_outputs(self.download_path, [os.path.basename(fn) for fn in files], self.use_DNN_vocal),
+		                     priority, self.use_DNN_vocal)
+
+	def schedule_vocal_jobs(self):
+		# songs that left the queue go back to backfill, the splitter is woken up for any new one
+		self.vocal_jobs.demote(NOW_PLAYING, BACKFILL)
+		if self.now_playing_filename:
+			self.push_vocal_jobs([self.now_playing_filename], NOW_PLAYING)
+		self.push_vocal_jobs([e['file'] for e in self.queue], QUEUED)
+
+	def set_vocal_split_mode(self, use_DNN):
+		if use_DNN != self.use_DNN_vocal:
+			self.use_DNN_vocal = use_DNN
+			self.vocal_jobs.cancel(not use_DNN)
+			self.schedule_vocal_jobs()
+			threading.Thread(target=self.push_vocal_jobs, args=(list(self.available_songs), BACKFILL), daemon=True).start()
+
+	def prefetch_transposed(self):
+		# render pitch-shifted variants of the current song and the next few, main audio and separated tracks
+		if self.transpose_cache:
+			songs = ([self.now_playing_filename] if self.now_playing_filename else []) + [e['file'] for e in self.queue[:self.transpose_lookahead]]
+			self.transpose_cache.schedule([[fn] + self.vocal_slaves(fn) for fn in songs])
+
+	def publish(self, event = 'status'):
+		self.pending_events.add(event)
+		self.event_dirty.set()
+
+	def pop_events(self):
+		self.event_dirty.clear()
+		events, self.pending_events = self.pending_events, set()
+		return events
 
 	def queue_clear(self):
 		logging.info("Clearing queue!")
-		self.queue = []
+		self.queue.clear()
 		self.update_queue()
 		self.skip()
 
@@ -732,16 +882,14 @@ class Karaoke:
 					diff = size - len(self.queue)
 					src -= diff
 					tgt -= diff
-				song = self.queue.pop(src)
-				self.queue.insert(tgt, song)
+				self.queue.move(src, tgt)
 			except:
 				logging.error("Invalid move song request: " + str(kwargs))
 				return False
 		else:
-			match = [(ii,each) for ii,each in enumerate(self.queue) if song_file in each["file"]]
-			index, song = match[0] if match else (-1, None)
+			index, song = self.queue.find(song_file)
 			if song == None:
-				logging.error("Song not found in queue: " + song["file"])
+				logging.error("Song not found in queue: " + song_file)
 				return False
 			if action == "up":
 				if index < 1:
@@ -749,16 +897,14 @@ class Karaoke:
 					return False
 				else:
 					logging.info("Bumping song up in queue: " + song["file"])
-					del self.queue[index]
-					self.queue.insert(index - 1, song)
+					self.queue.move(index, index - 1)
 			elif action == "down":
 				if index == len(self.queue) - 1:
 					logging.warn("Song is already last, can't bump down in queue: " + song["file"])
 					return False
 				else:
 					logging.info("Bumping song down in queue: " + song["file"])
-					del self.queue[index]
-					self.queue.insert(index + 1, song)
+					self.queue.move(index, index + 1)
 			elif action == "delete":
 				logging.info("Deleting song from queue: " + song["file"])
 				del self.queue[index]
@@ -784,6 +930,7 @@ class Karaoke:
 		if self.is_file_playing():
 			if self.use_vlc:
 				self.vlcclient.seek(seek_sec)
+				self.publish('seek')
 			else:
 				logging.warning("OMXplayer cannot seek track!")
 			return True
@@ -825,7 +972,7 @@ class Karaoke:
 				self.vlcclient.command(f"audiodelay&val={self.audio_delay}")
 			else:
 				logging.warning("OMXplayer cannot set audio delay!")
-			self.status_dirty = True
+			self.publish()
 			return self.audio_delay
 		logging.warning("Tried to set audio delay, but no file is playing!")
 		return False
@@ -852,7 +999,7 @@ class Karaoke:
 				self.vlcclient.command(f"subdelay&val={self.subtitle_delay}")
 			else:
 				logging.warning("OMXplayer cannot set subtitle delay!")
-			self.status_dirty = True
+			self.publish()
 			return self.subtitle_delay
 		logging.warning("Tried to set subtitle delay, but no file is playing!")
 		return False
@@ -861,7 +1008,8 @@ class Karaoke:
 		self.show_subtitle = not self.show_subtitle
 		if self.save_delays:
 			self.set_delays_dict(self.now_playing_filename, 'show_subtitle', self.show_subtitle, True)
-		self.play_vocal(force=True)
+		if not self.use_vlc or not self.switch_track('Subtitle', lambda ids: (ids[0] if self.show_subtitle else -1) if ids else None):
+			self.play_vocal(force=True)
 
 	def pause(self):
 		if self.is_file_playing():
@@ -880,7 +1028,7 @@ class Karaoke:
 				else:
 					self.omxclient.play()
 					self.is_paused = False
-			self.status_dirty = True
+			self.publish()
 			return True
 		else:
 			logging.warning("Tried to pause, but no file is playing!")
@@ -890,11 +1038,11 @@ class Karaoke:
 		if self.is_file_playing():
 			if self.use_vlc:
 				self.vlcclient.vol_up()
-				xml = self.vlcclient.command().text
-				self.volume = int(self.vlcclient.get_val_xml(xml, 'volume'))
+				self.volume = int(self.vlcclient.parse(self.vlcclient.command().text).volume)
 			else:
 				self.volume = self.omxclient.vol_up()
 			self.update_logical_vol()
+			self.publish()
 			return self.volume
 		else:
 			logging.warning("Tried to volume up, but no file is playing!")
@@ -904,11 +1052,11 @@ class Karaoke:
 		if self.is_file_playing():
 			if self.use_vlc:
 				self.vlcclient.vol_down()
-				xml = self.vlcclient.command().text
-				self.volume = int(self.vlcclient.get_val_xml(xml, 'volume'))
+				self.volume = int(self.vlcclient.parse(self.vlcclient.command().text).volume)
 			else:
 				self.volume = self.omxclient.vol_down()
 			self.update_logical_vol()
+			self.publish()
 			return self.volume
 		else:
 			logging.warning("Tried to volume down, but no file is playing!")
@@ -918,12 +1066,12 @@ class Karaoke:
 		if self.is_file_playing():
 			if self.use_vlc:
 				self.vlcclient.vol_set(volume)
-				xml = self.vlcclient.command().text
-				self.volume = int(self.vlcclient.get_val_xml(xml, 'volume'))
+				self.volume = int(self.vlcclient.parse(self.vlcclient.command().text).volume)
 			else:
 				logging.warning("Only VLC player can set volume, ignored!")
 				self.volume = self.omxclient.volume_offset
 			self.update_logical_vol()
+			self.publish()
 			return self.volume
 		else:
 			logging.warning("Tried to set volume, but no file is playing!")
@@ -933,9 +1081,9 @@ class Karaoke:
 		if self.is_file_playing():
 			if self.use_vlc:
 				self.vlcclient.playspeed_set(speed)
-				xml = self.vlcclient.command().text
-				self.play_speed = float(self.vlcclient.get_val_xml(xml, 'rate'))
+				self.play_speed = self.vlcclient.parse(self.vlcclient.command().text).rate
 				logging.info(f"Playback speed set to {self.play_speed}")
+				self.publish()
 			else:
 				logging.warning("Only VLC player can set playback speed, ignored!")
 			return self.play_speed
@@ -943,28 +1091,40 @@ class Karaoke:
 			logging.warning("Tried to set play speed, but no file is playing!")
 			return False
 
-	def try_set_vocal_mode(self, mode, now_playing_filename):
+	def vocal_track(self, mode, file_path, position = 0):
+		# (vocal mode, slave track) a song can be played with, 'mixed' if the wanted track is not available, changes no state
 		if mode not in ['mixed', 'vocal', 'nonvocal']:
 			mode = {1: 'nonvocal', 2: 'mixed', 3: 'vocal'}[self.get_vocal_mode()]
 		play_slave = '' if mode == 'mixed' else self.download_path + mode + '/' + ('' if self.use_DNN_vocal else '.') \
-		                                       + os.path.basename(now_playing_filename) + '.m4a'
+		                                       + os.path.basename(file_path) + '.m4a'
 		if os.path.isfile(play_slave):
-			self.vocal_mode = mode
-		else:
-			play_slave = ''
-			self.vocal_mode = 'mixed'
+			return mode, play_slave
+		if play_slave and partial_ready(play_slave, position, self.partial_lead_sec):
+			# still being separated, but far enough ahead of the playhead
+			return mode, partial_paths(play_slave)[0]
+		return 'mixed', ''
+
+	def try_set_vocal_mode(self, mode, now_playing_filename, position = 0):
+		self.vocal_mode, play_slave = self.vocal_track(mode, now_playing_filename, position)
 		return play_slave
 
 	def play_vocal(self, mode = None, force = False):
 		# mode=vocal/nonvocal/mixed, or else (use current)
 		if self.use_vlc:
-			play_slave = self.try_set_vocal_mode(mode, self.now_playing_filename)
+			position = Try(lambda: self.vlcclient.get_info_xml()['time'] or 0, 0)
+			play_slave = self.try_set_vocal_mode(mode, self.now_playing_filename, position)
 			if not force and self.now_playing_slave == play_slave:
 				return
-			status_xml = self.vlcclient.command().text if self.is_paused else self.vlcclient.pause(False).text
-			info = self.vlcclient.get_info_xml(status_xml)
-			posi = info['position']*info['length']
-			self.play_file(self.now_playing_filename, [f'--start-time={posi}'] + (['--start-paused'] if self.is_paused else []))
+			slaves = self.now_playing_slaves
+			def pick(ids):
+				# the main media's own audio tracks come first, then one per slave
+				if len(ids) <= len(slaves):
+					return None
+				return ids[len(ids)-len(slaves)+slaves.index(play_slave)] if play_slave else ids[0]
+			# transposed songs have only the pitch-shifted variant of the selected track loaded
+			if force or self.now_playing_transpose or (play_slave and play_slave not in slaves) or not self.switch_track('Audio', pick):
+				self.restart_at_position()
+			self.now_playing_slave = play_slave
 			self.get_vocal_info(True)
 		else:
 			logging.error("Not using VLC. Can't play vocal/nonvocal.")
@@ -992,6 +1152,12 @@ class Karaoke:
 			mask |= 0b00000100
 		if os.path.isfile(f'{self.download_path}vocal/.{bn}.m4a'):
 			mask |= 0b00001000
+		# tracks still being separated can be selected once they are far enough ahead
+		position = self.player_state.get('time') or 0
+		if not mask & 0b00000001 and partial_ready(f'{self.download_path}nonvocal/{bn}.m4a', position, self.partial_lead_sec):
+			mask |= 0b00000001
+		if not mask & 0b00000010 and partial_ready(f'{self.download_path}vocal/{bn}.m4a', position, self.partial_lead_sec):
+			mask |= 0b00000010
 		if 'vocal/.' in self.now_playing_slave:
 			mask |= 0b10000000
 		if self.use_DNN_vocal:
@@ -1021,6 +1187,7 @@ class Karaoke:
 			else:
 				self.omxclient.restart()
 			self.is_paused = False
+			self.publish('seek')
 			return True
 		else:
 			logging.warning("Tried to restart, but no file is playing!")
@@ -1062,6 +1229,7 @@ class Karaoke:
 		self.is_paused = True
 		self.now_playing_transpose = 0
 		self.now_playing_slave = ''
+		self.now_playing_slaves = []
 		self.audio_delay = 0
 		self.subtitle_delay = 0
 		self.show_subtitle = True
@@ -1069,6 +1237,7 @@ class Karaoke:
 		self.has_video = True
 		self.last_vocal_info = 0
 		self.play_speed = 1
+		self.publish()
 
 	def streamer_alive(self):
 		try:
@@ -1111,20 +1280,39 @@ class Karaoke:
 			os.system(f"tmux send-keys -t PiKaraoke:0.4 C-c")
 
 	def get_mp3_volume(self, filename):
+		# never blocks on analysis, a song not analysed yet plays unnormalised until the worker is done
 		try:
-			basename, md5, fsize = os.path.basename(filename), md5sum(filename), os.stat(filename).st_size
-			vol_fsize_md5 = self.song2vol.get(basename, [0]*3)
-			if fsize == vol_fsize_md5[1] and md5 == vol_fsize_md5[2]:
-				return vol_fsize_md5[0]
-			pcm_data = subprocess.check_output(['ffmpeg', '-i', filename, '-vn', '-f', 's16le', '-acodec', 'pcm_s16le', '-'], stderr = subprocess.DEVNULL)
-			volume_val = np.clip(np.sqrt(np.std(np.frombuffer(pcm_data, dtype = np.int16))/STD_VOL), 1/16, 16)
-			self.song2vol[basename] = [volume_val, fsize, md5]
-			with Open(self.download_path+'/.mp3_volume.json.gz', 'wb') as fp:
-				json.dump(self.song2vol, fp, indent=1)
-			return volume_val
-		except:
-			self.normalize_vol = False
+			volume_val = self.volume_store.get(filename)
+		except OSError:
+			return 1
+		if volume_val is None:
+			self.loudness_worker.request([filename], -1)
 			return 1
+		return volume_val
+
+	def schedule_loudness(self):
+		# queued songs first, then the rest of the library in the background
+		if self.normalize_vol:
+			self.loudness_worker.request([e['file'] for e in self.queue], 0)
+			known = self.volume_store.known()
+			self.loudness_worker.request([fn for fn in self.available_songs if os.path.basename(fn) not in known], 1)
+
+	def analyse_mp3_volume(self, filename):
+		# runs in the loudness worker threads
+		if not os.path.isfile(filename) or self.volume_store.get(filename) is not None:
+			return
+		# entries migrated from the old cache are checked by md5 here, not on the play_file path
+		volume_val = self.volume_store.get(filename, verify_md5 = True)
+		if volume_val is None:
+			pcm_std, lufs = loudness.analyse(filename, niceness = 10)
+			volume_val = np.clip(np.sqrt(pcm_std/STD_VOL), 1/16, 16)
+			self.volume_store.put(filename, volume_val, lufs)
+		if filename == self.now_playing_filename and self.normalize_vol and self.logical_volume is not None and self.use_vlc:
+			# the song started unnormalised, bring it to the logical volume now
+			self.media_vol = volume_val
+			self.volume = round(self.logical_volume / np.sqrt(volume_val))
+			self.vlcclient.vol_set(self.volume)
+			self.publish()
 
 	def update_logical_vol(self):
 		if hasattr(self, 'media_vol'):
@@ -1138,6 +1326,8 @@ class Karaoke:
 			self.volume = self.vlcclient.get_info_xml()['volume']
 			self.media_vol = self.get_mp3_volume(self.now_playing_filename)
 			self.update_logical_vol()
+		self.schedule_loudness()
+		self.publish()
 		return str(self.logical_volume)
 
 	def init_save_delays(self):
@@ -1181,6 +1371,7 @@ class Karaoke:
 						self.reset_now_playing()
 						self.render_splash_screen()
 						tm = time.time()
+						self.preload_next()
 						while time.time()-tm < self.splash_delay:
 							self.handle_run_loop()
 						head = self.queue.pop(0)
@@ -1,10 +1,12 @@
 import os, sys, io, string, json, subprocess, yt_dlp, gzip
-import pykakasi, pinyin, logging, requests, shutil, hashlib
+import pykakasi, pinyin, logging, requests, shutil
+import bisect, threading
 from unidecode import unidecode
 from urllib.parse import unquote
 
 from lib.ChineseNumber import *
 from lib.settings import *
+from lib.search import NgramIndex
 
 KKS = pykakasi.kakasi()
 filelist, cookies_opt = [], []
@@ -37,8 +39,6 @@ def Open(fn, mode='r', **kwargs):
 	fn = expand_path(fn)
 	return gzip.open(fn, mode, **kwargs) if fn.lower().endswith('.gz') else open(fn, mode, **kwargs)
 
-md5sum = lambda filepath: hashlib.md5(Open(filepath,'rb').read()).hexdigest()
-
 def Try(*args):
 	exc = ''
 	for arg in args:
@@ -71,14 +71,109 @@ def filepath2songtitle(fn):
 	return os.path.basename(os.path.dirname(unquote(fn).rstrip('/')))+s if s.isdigit() else s
 
 
-def findSong(name, lang=None, flist=filelist):
-	name = name.lower().strip()
-	name_list = [filepath2songtitle(fn).lower() for fn in flist]
+def phonetic_keys(name):
+	# all transformations of a lowercased title that findSong() compares against
+	greek = fuzzy(name, FUZZY_GREEK)
+	pinyin_str = fuzzy(to_pinyin(num2zh(name)))
+	return {'name': name, 'greek': greek,
+		'pinyin_alnum': get_alnum(pinyin_str), 'pinyin_alpha': get_alpha(pinyin_str),
+		'romaji': get_alpha(to_romaji(name)),
+		'translit': get_alpha(fuzzy(translit(name))), 'translit_greek': get_alpha(fuzzy(translit(greek)))}
+
+
+class PhoneticIndex:
+	"""Persistent cache of phonetic_keys() for every media file, so that a voice query only transforms the query"""
+	save_delay = 10
+
+	def __init__(self, cache_file = None):
+		self.cache_file = cache_file
+		self.keys = {}      # full path => phonetic keys
+		self.files = []     # full paths of media files, sorted like ls_media_files()
+		self.fuzzy_indices = {}  # phonetic key kind => NgramIndex, built on first fuzzy lookup of that kind
+		self.save_timer = None
+		self.lock = threading.RLock()
+		try:
+			with gzip.open(cache_file, 'rt', encoding='utf-8') as fp:
+				self.keys = json.load(fp)
+		except Exception:
+			pass
+
+	def is_media(self, fn):
+		return not os.path.basename(fn).startswith('.') and '.'+fn.split('.')[-1] in media_file_exts
+
+	def get(self, fn):
+		keys = self.keys.get(fn)
+		if keys is None:
+			keys = self.keys[fn] = phonetic_keys(filepath2songtitle(fn).lower())
+			self.save_later()
+		return keys
+
+	def fuzzy_index(self, kind):
+		with self.lock:
+			if kind not in self.fuzzy_indices:
+				ix = NgramIndex(2)
+				ix.rebuild((fn, self.get(fn)[kind]) for fn in self.files)
+				self.fuzzy_indices[kind] = ix
+			return self.fuzzy_indices[kind]
+
+	def update(self, new_files = (), gone_files = ()):
+		with self.lock:
+			for ix in self.fuzzy_indices.values():
+				for fn in gone_files:
+					ix.remove(fn)
+			for fn in gone_files:
+				self.keys.pop(fn, None)
+				ii = bisect.bisect_left(self.files, fn)
+				if ii < len(self.files) and self.files[ii] == fn:
+					del self.files[ii]
+			for fn in new_files:
+				if self.is_media(fn):
+					ii = bisect.bisect_left(self.files, fn)
+					if ii == len(self.files) or self.files[ii] != fn:
+						self.files.insert(ii, fn)
+		# compute outside the lock, pinyin/romaji conversion is slow
+		for fn in new_files:
+			if self.is_media(fn):
+				keys = self.get(fn)
+				with self.lock:
+					for kind, ix in self.fuzzy_indices.items():
+						ix.add(fn, keys[kind])
+		if gone_files:
+			self.save_later()
+
+	def sync(self, flist):
+		with self.lock:
+			files = set(flist)
+			self.files = sorted(fn for fn in files if self.is_media(fn))
+			gone = [fn for fn in self.keys if fn not in files]
+			self.fuzzy_indices.clear()
+		self.update(self.files, gone)
+		logging.info(f"Phonetic index: {len(self.keys)} songs")
+
+	def save(self):
+		with self.lock:
+			self.save_timer = None
+			keys = dict(self.keys)
+		try:
+			with gzip.open(self.cache_file, 'wt', encoding='utf-8') as fp:
+				json.dump(keys, fp, ensure_ascii=False, separators=(',', ':'))
+		except Exception as e:
+			logging.warning(f"Failed to save phonetic index {self.cache_file}: {e}")
+
+	def save_later(self):
+		if self.cache_file and self.save_timer is None:
+			self.save_timer = threading.Timer(self.save_delay, self.save)
+			self.save_timer.daemon = True
+			self.save_timer.start()
+
+
+def findSong(name, lang=None, flist=filelist, index=None):
+	query = phonetic_keys(name.lower().strip())
+	keys = [index.get(fn) if index else phonetic_keys(filepath2songtitle(fn).lower()) for fn in flist]
 
 	# 0. pre-transform
-	if lang == 'el':
-		name = fuzzy(name, FUZZY_GREEK)
-		name_list = [fuzzy(n, FUZZY_GREEK) for n in name_list]
+	name_key = 'greek' if lang == 'el' else 'name'
+	name, name_list = query[name_key], [k[name_key] for k in keys]
 
 	# 1. exact full match of original form
 	if name in name_list:
@@ -87,23 +182,16 @@ def findSong(name, lang=None, flist=filelist):
 	# 2. match by pinyin if Chinese or unknown
 	if lang in [None, 'zh']:
 		# 3. pinyin full match
-		pinyin_list = [get_alnum(fuzzy(to_pinyin(num2zh(n)))) for n in name_list]
-		pinyin_name = get_alnum(fuzzy(to_pinyin(num2zh(name))))
-		res = str_search(pinyin_name, pinyin_list)
-		if pinyin_name and res:
-			return res
-		pinyin_list = [get_alpha(fuzzy(to_pinyin(num2zh(n)))) for n in name_list]
-		pinyin_name = get_alpha(fuzzy(to_pinyin(num2zh(name))))
-		if pinyin_name and res:
-			return res
+		for key in ['pinyin_alnum', 'pinyin_alpha']:
+			res = str_search(query[key], [k[key] for k in keys])
+			if query[key] and res:
+				return res
 
 	# 3. match by romaji if Japanese or unknown
 	if lang in [None, 'ja']:
 		# 5. romaji full match
-		romaji_list = [get_alpha(to_romaji(n)) for n in name_list]
-		romaji_name = get_alpha(to_romaji(name))
-		res = str_search(romaji_name, romaji_list)
-		if romaji_name and res:
+		res = str_search(query['romaji'], [k['romaji'] for k in keys])
+		if query['romaji'] and res:
 			return res
 
 	# 4. substring match
@@ -112,18 +200,33 @@ def findSong(name, lang=None, flist=filelist):
 		return res
 	
 	# 5. match by transliteration
-	translit_list = [get_alpha(fuzzy(translit(n))) for n in name_list]
-	translit_name = get_alpha(fuzzy(translit(name)))
-	res = str_search(translit_name, translit_list)
-	if translit_name and res:
+	translit_key = 'translit_greek' if lang == 'el' else 'translit'
+	res = str_search(query[translit_key], [k[translit_key] for k in keys])
+	if query[translit_key] and res:
 		return res
 
+	# 6. approximate match of the phonetic form, tolerates ASR near misses
+	kind = {'zh': 'pinyin_alpha', 'ja': 'romaji', 'el': 'translit_greek'}.get(lang, 'translit')
+	if index is not None:
+		ix = index.fuzzy_index(kind)
+	else:
+		ix = NgramIndex(2)
+		ix.rebuild((ii, k[kind]) for ii, k in enumerate(keys))
+	res = ix.fuzzy(query[kind], limit = 10)
+	if index is not None:
+		posi = {fn: ii for ii, fn in enumerate(flist)}
+		res = [(dist, posi[fn]) for dist, fn in res if fn in posi]
+	if res:
+		best = res[0][0]
+		return [ii for dist, ii in res if dist == best]
+
 	return []
 
 
-def findMedia(base_path, name, lang=None, stack=0):
-	f_lst = ls_media_files(base_path)
-	res = findSong(name, lang, f_lst)
+def findMedia(base_path, name, lang=None, stack=0, index=None):
+	# the index only covers the download path itself, subdirectories are still listed
+	f_lst = list(index.files) if index is not None else ls_media_files(base_path)
+	res = findSong(name, lang, f_lst, index)
 	if res:
 		return [f_lst[i] for i in res]
 	if stack<MAX_WALK_LEVEL:
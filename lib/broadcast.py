@@ -0,0 +1,68 @@
+import logging, threading
+from collections import OrderedDict
+
+
+class ClientChannel:
+	"""Websocket wrapper with a bounded outgoing queue, drained by its own sender thread
+
+	send() never blocks on the network, so one slow client cannot hold up the others. Messages sent
+	with a key replace the undelivered one with the same key (only the latest status/seek matters),
+	when the queue is full the oldest message is dropped, and a failed send closes the channel.
+	"""
+	max_pending = 64
+
+	def __init__(self, sock, on_close = None):
+		self.sock = sock
+		self.on_close = on_close
+		self.pending = OrderedDict()    # key => message, unkeyed messages get a sequence number
+		self.seq = 0
+		self.dropped = 0
+		self.closed = False
+		self.cond = threading.Condition()
+		threading.Thread(target = self.run, daemon = True).start()
+
+	@property
+	def connected(self):
+		return not self.closed and self.sock.connected
+
+	def send(self, msg, key = None):
+		with self.cond:
+			if self.closed:
+				return
+			if key is None:
+				self.seq += 1
+				key = self.seq
+			else:
+				self.pending.pop(key, None)
+			self.pending[key] = msg
+			if len(self.pending) > self.max_pending:
+				self.pending.popitem(last = False)
+				self.dropped += 1
+			self.cond.notify()
+
+	def run(self):
+		while True:
+			with self.cond:
+				while not self.pending and not self.closed:
+					self.cond.wait()
+				if self.closed:
+					return
+				_, msg = self.pending.popitem(last = False)
+			try:
+				self.sock.send(msg)
+			except Exception as e:
+				logging.info(f"Websocket send failed, evicting client: {e}")
+				self.close()
+				return
+
+	def close(self):
+		with self.cond:
+			if self.closed:
+				return
+			self.closed = True
+			self.pending.clear()
+			self.cond.notify()
+		if self.dropped:
+			logging.info(f"Websocket client closed after dropping {self.dropped} stale messages")
+		if self.on_close:
+			self.on_close(self)
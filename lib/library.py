@@ -0,0 +1,207 @@
+import os, bisect, gzip, json, logging, threading, time
+from collections.abc import Mapping
+
+from unidecode import unidecode
+
+from lib.search import NgramIndex
+
+
+class SortedTrans(Mapping):
+	"""Read-only full path => transliteration view of a SongLibrary, iterated in sort order"""
+
+	def __init__(self, library):
+		self.library = library
+
+	def __getitem__(self, fn):
+		return self.library.trans[fn]
+
+	def __len__(self):
+		return len(self.library.keys)
+
+	def __iter__(self):
+		return iter(self.library.songs)
+
+	def items(self):
+		return ((fn, trans) for trans, fn in self.library.keys)
+
+
+class SongLibrary:
+	"""Sorted index of the media files in the download path, maintained one file at a time"""
+	save_delay = 5	# seconds, coalesces catalogue writes from consecutive add/remove/rename
+
+	def __init__(self, path, media_exts, get_title, catalogue = None):
+		self.path = path
+		self.media_exts = media_exts
+		self.get_title = get_title
+		self.catalogue = catalogue    # on-disk cache of {basename: [size, mtime, transliteration]}
+		self.songs = []     # full paths, kept sorted by transliteration
+		self.trans = {}     # full path => transliteration, used for sorting and initial letter search
+		self.keys = []      # sort keys, parallel to self.songs
+		self.sorted_trans = SortedTrans(self)   # self.trans in the order of self.songs
+		self.stats = {}     # full path => (size, mtime)
+		self.index = NgramIndex()   # substring index over lowercased titles and transliterations
+		self.dir_mtime = None
+		self.save_timer = None
+		self.listeners = []     # called with (new_files, gone_files) after every change
+		self.lock = threading.RLock()
+
+	def is_media(self, bn):
+		return not bn.startswith('.') and os.path.splitext(bn)[1].lower() in self.media_exts
+
+	def transliterate(self, fn):
+		trans = unidecode(self.get_title(fn)).lower()
+		# strip leading non-transliterable symbols
+		while trans and not trans[0].islower() and not trans[0].isdigit():
+			trans = trans[1:]
+		return trans
+
+	def search_text(self, fn):
+		return self.get_title(fn).lower() + '\n' + self.trans[fn]
+
+	def stat(self, fn):
+		try:
+			st = os.stat(fn)
+			return (st.st_size, st.st_mtime)
+		except OSError:
+			return None
+
+	def _insert(self, fn, trans, stat):
+		key = (trans, fn)
+		ii = bisect.bisect_left(self.keys, key)
+		self.keys.insert(ii, key)
+		self.songs.insert(ii, fn)
+		self.trans[fn] = trans
+		self.stats[fn] = stat
+		self.index.add(fn, self.search_text(fn))
+
+	def _remove(self, fn):
+		ii = bisect.bisect_left(self.keys, (self.trans.pop(fn), fn))
+		del self.keys[ii], self.songs[ii]
+		self.stats.pop(fn, None)
+		self.index.remove(fn)
+
+	def _rebuild(self):
+		self.keys[:] = sorted((v, k) for k, v in self.trans.items())
+		self.songs[:] = [k for _, k in self.keys]
+		self.index.rebuild((fn, self.search_text(fn)) for fn in self.songs)
+
+	def load(self):
+		try:
+			with gzip.open(self.catalogue, 'rt', encoding='utf-8') as fp:
+				obj = json.load(fp)
+			self.trans.update({self.path+bn: v[2] for bn, v in obj['songs'].items()})
+			self.stats.update({self.path+bn: (v[0], v[1]) for bn, v in obj['songs'].items()})
+			self._rebuild()
+			return obj['dir_mtime']
+		except Exception as e:
+			if os.path.exists(self.catalogue):
+				logging.warning(f"Failed to load song catalogue {self.catalogue}: {e}")
+			return None
+
+	def save(self):
+		with self.lock:
+			self.save_timer = None
+			songs = {os.path.basename(fn): [*self.stats[fn], self.trans[fn]] for fn in self.songs}
+			obj = {'dir_mtime': self.dir_mtime, 'songs': songs}
+		try:
+			# writing in place does not change the directory mtime, unlike create-and-rename
+			with gzip.open(self.catalogue, 'wt', encoding='utf-8') as fp:
+				json.dump(obj, fp, ensure_ascii=False, separators=(',', ':'))
+		except Exception as e:
+			logging.warning(f"Failed to save song catalogue {self.catalogue}: {e}")
+
+	def notify(self, new, gone):
+		for listener in self.listeners:
+			try:
+				listener(new, gone)
+			except Exception:
+				logging.exception("Song library listener failed")
+
+	def save_later(self):
+		if self.catalogue and self.save_timer is None:
+			self.save_timer = threading.Timer(self.save_delay, self.save)
+			self.save_timer.daemon = True
+			self.save_timer.start()
+
+	def scan(self):
+		# only new or modified files are transliterated, the rest comes from memory or the catalogue
+		with self.lock:
+			tm = time.time()
+			dir_mtime, saved_mtime = os.stat(self.path).st_mtime, self.dir_mtime
+			if not self.songs and self.catalogue:
+				saved_mtime = self.load()
+			if saved_mtime == dir_mtime:
+				self.dir_mtime = dir_mtime
+				logging.info(f"Song library: {len(self.songs)} songs loaded from catalogue in {time.time()-tm:.3f}s")
+				return set(), set()
+
+			found = {}
+			for bn in os.listdir(self.path):
+				if self.is_media(bn):
+					stat = self.stat(self.path+bn)
+					if stat is not None and os.path.isfile(self.path+bn):
+						found[self.path+bn] = stat
+			changed = {fn for fn, stat in found.items() if fn in self.stats and self.stats[fn] != stat}
+			gone, new = (self.trans.keys()-found.keys())|changed, (found.keys()-self.trans.keys())|changed
+			if len(gone)+len(new) > len(self.songs)//8:
+				for fn in gone:
+					self.trans.pop(fn)
+					self.stats.pop(fn, None)
+				self.trans.update({fn: self.transliterate(fn) for fn in new})
+				self.stats.update({fn: found[fn] for fn in new})
+				self._rebuild()
+			else:
+				for fn in gone:
+					self._remove(fn)
+				for fn in new:
+					self._insert(fn, self.transliterate(fn), found[fn])
+			self.dir_mtime = dir_mtime
+			if self.catalogue and (gone or new or saved_mtime != dir_mtime):
+				self.save()
+			logging.info(f"Song library: {len(self.songs)} songs, {len(new)} (re)transliterated, {len(gone)} removed in {time.time()-tm:.3f}s")
+		if gone or new:
+			self.notify(new, gone)
+		return new, gone
+
+	def add(self, fn):
+		with self.lock:
+			if fn in self.trans or not self.is_media(os.path.basename(fn)) or not os.path.isfile(fn):
+				return False
+			self._insert(fn, self.transliterate(fn), self.stat(fn))
+			self.dir_mtime = None
+			self.save_later()
+		self.notify([fn], [])
+		return True
+
+	def remove(self, fn):
+		with self.lock:
+			if fn not in self.trans:
+				return False
+			self._remove(fn)
+			self.dir_mtime = None
+			self.save_later()
+		self.notify([], [fn])
+		return True
+
+	def rename(self, old_fn, new_fn):
+		with self.lock:
+			self.remove(old_fn)
+			return self.add(new_fn)
+
+	def search(self, q, limit = 50, fuzzy = 0):
+		# fuzzy: typo-tolerant matches are added when there are fewer exact ones than this
+		q = q.lower().strip()
+		if not q:
+			return []
+		with self.lock:
+			res = self.index.search(q, limit)
+			if res is not None:
+				if len(res) < min(fuzzy, limit):
+					res += [fn for _, fn in self.index.fuzzy(q, limit) if fn not in res][:limit-len(res)]
+				return res
+			# queries shorter than an n-gram are matched as a prefix of the sorted transliterations
+			res, ii = [], bisect.bisect_left(self.keys, (q,))
+			while ii < len(self.keys) and len(res) < limit and self.keys[ii][0].startswith(q):
+				res += [self.keys[ii][1]]
+				ii += 1
+			return res
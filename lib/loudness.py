@@ -0,0 +1,115 @@
+import re, heapq, logging, shutil, subprocess, tempfile, threading
+import numpy as np
+
+CHUNK_SIZE = 1 << 20	# bytes of 16-bit PCM read from ffmpeg at a time
+
+
+class RunningStats:
+	"""Mean and standard deviation of a sample stream, accumulated chunk by chunk"""
+
+	def __init__(self):
+		self.n = 0
+		self.sum = 0.0
+		self.sum_sq = 0.0
+
+	def update(self, samples):
+		x = samples.astype(np.float64)
+		self.n += x.size
+		self.sum += x.sum()
+		self.sum_sq += np.dot(x, x)
+
+	@property
+	def std(self):
+		if not self.n:
+			return 0.0
+		mean = self.sum/self.n
+		return float(np.sqrt(max(self.sum_sq/self.n - mean*mean, 0.0)))
+
+
+def parse_ebur128(lines):
+	# the summary at the end of the ebur128 filter log has 'I: -14.2 LUFS', read line by line
+	found = None
+	for line in lines:
+		m = re.search(r'I:\s+(-?[\d.]+|-inf) LUFS', line)
+		if m:
+			found = m.group(1)
+	return float(found) if found and found != '-inf' else None
+
+
+def analyse(filename, ebur128 = True, chunk_size = CHUNK_SIZE, niceness = 0):
+	"""(std of the 16-bit PCM samples, EBU R128 integrated loudness in LUFS or None), in constant memory
+
+	The std is the same as np.std over the whole decoded signal, the loudness comes from ffmpeg's ebur128
+	filter in the same decoding pass, which passes the audio through unchanged.
+	"""
+	# framelog=quiet leaves only the summary in the log, instead of a line per 100 ms of audio
+	cmd = ['ffmpeg', '-nostdin', '-nostats', '-i', filename, '-vn'] + (['-af', 'ebur128=framelog=quiet'] if ebur128 else []) \
+	      + ['-f', 's16le', '-acodec', 'pcm_s16le', '-']
+	if niceness and shutil.which('nice'):
+		cmd = ['nice', '-n', str(niceness)] + cmd
+	stats, rest = RunningStats(), b''
+	# decoder warnings can still be many, a file cannot fill up and block ffmpeg like a pipe would
+	with tempfile.TemporaryFile() as log:
+		proc = subprocess.Popen(cmd, stdin = subprocess.DEVNULL, stdout = subprocess.PIPE, stderr = log if ebur128 else subprocess.DEVNULL)
+		while True:
+			data = proc.stdout.read(chunk_size)
+			if not data:
+				break
+			data, rest = rest + data, b''
+			if len(data) % 2:
+				data, rest = data[:-1], data[-1:]
+			stats.update(np.frombuffer(data, dtype = np.int16))
+		if proc.wait() != 0:
+			raise subprocess.CalledProcessError(proc.returncode, cmd)
+		log.seek(0)
+		lufs = parse_ebur128(line.decode('utf-8', 'replace') for line in log) if ebur128 else None
+	return stats.std, lufs
+
+
+class LoudnessWorker:
+	"""Threads running loudness analysis in the background, lowest priority value first
+
+	analyse(filename) does the work and stores the result. A file requested again with a more urgent
+	priority is moved up, the superseded heap entry is skipped when popped.
+	"""
+
+	def __init__(self, analyse, workers = 1):
+		self.analyse = analyse
+		self.heap = []      # (priority, seq, filename)
+		self.jobs = {}      # filename => priority of its live heap entry
+		self.running = set()
+		self.seq = 0
+		self.cond = threading.Condition()
+		for _ in range(workers):
+			threading.Thread(target = self.run, daemon = True).start()
+
+	def request(self, files, priority):
+		with self.cond:
+			for fn in files:
+				if fn not in self.running and priority < self.jobs.get(fn, float('inf')):
+					self.jobs[fn] = priority
+					heapq.heappush(self.heap, (priority, self.seq, fn))
+					self.seq += 1
+			self.cond.notify_all()
+
+	def next_job(self):
+		with self.cond:
+			while True:
+				while not self.heap:
+					self.cond.wait()
+				priority, _, fn = heapq.heappop(self.heap)
+				if self.jobs.get(fn) == priority:
+					del self.jobs[fn]
+					self.running.add(fn)
+					return fn
+
+	def run(self):
+		while True:
+			fn = self.next_job()
+			try:
+				self.analyse(fn)
+			except Exception as e:
+				logging.warning(f"Loudness analysis of {fn} failed: {e}")
+			finally:
+				with self.cond:
+					self.running.discard(fn)
@@ -0,0 +1,137 @@
+import heapq
+from collections import defaultdict, Counter
+
+
+def pattern_masks(q):
+	# bit i of masks[c] is set where q[i] == c
+	masks = defaultdict(int)
+	for i, c in enumerate(q):
+		masks[c] |= 1 << i
+	return masks
+
+
+def substring_distance(q, text, max_dist = None, masks = None):
+	"""Edit distance between q and its best matching substring of text (Myers' bit-parallel form of Sellers' algorithm)
+
+	masks are pattern_masks(q), worth passing in when one query is matched against many texts.
+	"""
+	m = len(q)
+	if max_dist is None:
+		max_dist = m
+	if m == 0:
+		return 0
+	peq = pattern_masks(q) if masks is None else masks
+	# bit i of the vertical delta vectors is the difference between rows i+1 and i of the current DP column
+	mask, high = (1 << m) - 1, 1 << (m-1)
+	pv, mv, score = mask, 0, m
+	best = score
+	for c in text:
+		eq = peq.get(c, 0)
+		xv = eq | mv
+		xh = (((eq & pv) + pv) ^ pv) | eq
+		ph = mv | (~(xh | pv) & mask)
+		mh = pv & xh
+		if ph & high:
+			score += 1
+		elif mh & high:
+			score -= 1
+		# a match may start anywhere in text, so row 0 stays 0 and nothing is shifted in
+		ph, mh = (ph << 1) & mask, (mh << 1) & mask
+		pv = mh | (~(xv | ph) & mask)
+		mv = ph & xv
+		if score < best:
+			best = score
+			if best == 0:
+				break
+	return best if best <= max_dist else None
+
+
+class NgramIndex:
+	"""Substring index over short texts, using n-gram postings to find candidates"""
+
+	def __init__(self, n = 3):
+		self.n = n
+		self.texts = {}     # key => indexed text
+		self.postings = defaultdict(list)   # n-gram => keys, removed keys are skipped and purged lazily
+		self.garbage = 0
+
+	def grams(self, text):
+		return {text[i:i+self.n] for i in range(len(text)-self.n+1)}
+
+	def add(self, key, text):
+		if key in self.texts:
+			self.remove(key)
+		self.texts[key] = text
+		for g in self.grams(text):
+			self.postings[g].append(key)
+
+	def remove(self, key):
+		if self.texts.pop(key, None) is not None:
+			self.garbage += 1
+			if self.garbage > len(self.texts)//2 + 1000:
+				self.rebuild()
+
+	def rebuild(self, items = None):
+		if items is not None:
+			self.texts = dict(items)
+		self.postings.clear()
+		for key, text in self.texts.items():
+			for g in self.grams(text):
+				self.postings[g].append(key)
+		self.garbage = 0
+
+	def fuzzy(self, q, limit = 10, max_dist = None, max_candidates = 32, max_postings = 2000):
+		"""Approximate substring search, returns [(distance, key)] with at most max_dist edits
+
+		At most max_postings postings are counted, rarest n-grams first, and at most max_candidates texts are verified.
+		"""
+		if max_dist is None:
+			max_dist = max(1, len(q)//4)
+		qgrams = self.grams(q)
+		if not qgrams:
+			return []
+		# q-gram lemma: a match with d edits still shares at least |qgrams|-d*n n-grams with the query,
+		# every n-gram left uncounted lowers that bound by one
+		postings = sorted((self.postings.get(g, []) for g in qgrams), key = len)
+		counts, budget, skipped = Counter(), max_postings, 0
+		for keys in postings:
+			if len(keys) > budget:
+				skipped += 1
+				continue
+			budget -= len(keys)
+			counts.update(set(keys))
+		# for short queries the bound is useless and every text sharing a gram is a candidate, best first
+		min_shared = max(1, len(qgrams) - max_dist*self.n - skipped)
+		cands = heapq.nlargest(max_candidates, [(c, key) for key, c in counts.items() if c >= min_shared and key in self.texts])
+		res, masks = [], pattern_masks(q)
+		for c, key in cands:
+			text = self.texts[key]
+			dist = substring_distance(q, text, max_dist, masks)
+			if dist is not None:
+				res += [((dist, -c, len(text)), key)]
+		return [(score[0], key) for score, key in heapq.nsmallest(limit, res)]
+
+	@staticmethod
+	def rank(text, posi):
+		# prefix matches first, then matches at a word boundary, then earlier and shorter
+		return (posi != 0, posi > 0 and text[posi-1].isalnum(), posi, len(text))
+
+	def search(self, q, limit = 50):
+		if len(q) < self.n:
+			return None
+		postings = [self.postings.get(g, []) for g in self.grams(q)]
+		res, seen, prefixes = [], set(), 0
+		# the rarest n-gram gives the fewest candidates, each is then verified with a plain substring test;
+		# nothing ranks before a prefix match, so the scan stops at the limit-th one
+		for key in min(postings, key = len):
+			text = self.texts.get(key)
+			if text is None or key in seen:
+				continue
+			seen.add(key)
+			posi = text.find(q)
+			if posi >= 0:
+				res += [(self.rank(text, posi), key)]
+				prefixes += posi == 0
+				if prefixes >= limit:
+					break
+		return [key for _, key in heapq.nsmallest(limit, res)]
@@ -0,0 +1,106 @@
+from collections import deque
+
+
+class SongQueue(list):
+	"""Play queue of {'user', 'file', 'title'} entries, with a file => entry index for O(1) membership
+
+	Every change bumps `version` and is logged as a small delta op, so that clients which are
+	only a few versions behind can be brought up to date without resending the whole queue:
+	['ins', pos, [entries]], ['del', pos], ['mov', src, tgt], ['set', pos, entry], ['clr']
+	"""
+	max_log = 256
+
+	def __init__(self, entries = ()):
+		super().__init__(entries)
+		self.by_file = {e['file']: e for e in self}
+		self.version = 0
+		self.log = deque(maxlen = self.max_log)    # (version, op)
+
+	def _log(self, *op):
+		self.version += 1
+		self.log.append((self.version, list(op)))
+
+	def ops_since(self, version):
+		"""(ops, new_version) bringing a client from `version` up to date, ops is None if it is too far behind"""
+		log = list(self.log)
+		current = log[-1][0] if log else self.version
+		if version is None or version > current:
+			return None, current
+		if version == current:
+			return [], current
+		if not log or log[0][0] > version+1:
+			return None, current
+		return [op for v, op in log if v > version], current
+
+	def has(self, song_path):
+		return song_path in self.by_file
+
+	def position(self, entry):
+		for ii, e in enumerate(self):
+			if e is entry:
+				return ii
+		return -1
+
+	def find(self, song_file):
+		# exact path first, then the legacy substring match used by the web UI
+		entry = self.by_file.get(song_file)
+		if entry is None:
+			entry = next((e for e in self if song_file in e['file']), None)
+		return (-1, None) if entry is None else (self.position(entry), entry)
+
+	def append(self, entry):
+		self.insert(len(self), entry)
+
+	def extend(self, entries):
+		entries = list(entries)
+		if entries:
+			self._log('ins', len(self), entries)
+			super().extend(entries)
+			self.by_file.update({e['file']: e for e in entries})
+
+	def insert(self, ii, entry):
+		ii = min(len(self), ii)
+		super().insert(ii, entry)
+		self.by_file[entry['file']] = entry
+		self._log('ins', ii, [entry])
+
+	def pop(self, ii = -1):
+		if ii < 0:
+			ii += len(self)
+		entry = super().pop(ii)
+		self.by_file.pop(entry['file'], None)
+		self._log('del', ii)
+		return entry
+
+	def remove(self, entry):
+		ii = self.position(entry)
+		if ii < 0:
+			raise ValueError('entry not in queue')
+		self.pop(ii)
+
+	def __delitem__(self, ii):
+		self.pop(ii)
+
+	def clear(self):
+		super().clear()
+		self.by_file.clear()
+		self._log('clr')
+
+	def move(self, src, tgt):
+		if src < 0:
+			src += len(self)
+		entry = super().pop(src)
+		super().insert(tgt, entry)
+		self._log('mov', src, self.position(entry))
+
+	def touch(self, entry):
+		"""Record an in-place change of an entry's fields"""
+		self._log('set', self.position(entry), entry)
+
+	def rename(self, old_file, new_file, new_title):
+		entry = self.by_file.pop(old_file, None)
+		if entry is not None:
+			entry['file'], entry['title'] = new_file, new_title
+			self.by_file[new_file] = entry
+			self.touch(entry)
+		return entry
@@ -0,0 +1,97 @@
+import os, heapq, logging, shutil, subprocess, threading
+
+
+class TransposeCache:
+	"""Pitch-shifted audio variants rendered offline with ffmpeg, kept in a size-capped LRU directory
+
+	Playing a variant as a plain slave track avoids VLC's real-time scaletempo_pitch, which is too heavy
+	for a Raspberry Pi. The file mtime is the LRU timestamp, lookup() refreshes it.
+	"""
+
+	def __init__(self, path, max_bytes, max_semitones = 4):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.semitones = sorted([n for n in range(-max_semitones, max_semitones+1) if n], key = abs)
+		self.jobs = []      # heap of (priority, |semitones|, source, semitones)
+		self.cond = threading.Condition()
+		self.rubberband = None
+		os.makedirs(path, exist_ok = True)
+		threading.Thread(target = self.run, daemon = True).start()
+
+	def variant_path(self, src, semitones):
+		# the parent directory keeps the vocal/ and nonvocal/ tracks of a song apart
+		parent, bn = os.path.split(os.path.abspath(src))
+		return os.path.join(self.path, f'{os.path.basename(parent)}~{bn}.{semitones:+d}.m4a')
+
+	def lookup(self, src, semitones):
+		fn = self.variant_path(src, semitones)
+		if os.path.isfile(fn):
+			os.utime(fn)
+			return fn
+		return None
+
+	def schedule(self, groups):
+		"""Replace the pending jobs, groups is a list of source file lists in decreasing priority"""
+		jobs = [(prio, abs(n), src, n) for prio, sources in enumerate(groups) for src in sources
+		        for n in self.semitones if not os.path.isfile(self.variant_path(src, n))]
+		heapq.heapify(jobs)
+		with self.cond:
+			self.jobs = jobs
+			self.cond.notify()
+
+	def has_rubberband(self):
+		if self.rubberband is None:
+			filters = subprocess.run(['ffmpeg', '-hide_banner', '-filters'], capture_output = True, text = True).stdout
+			self.rubberband = ' rubberband ' in filters
+		return self.rubberband
+
+	def sample_rate(self, src):
+		out = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'a:0', '-show_entries', 'stream=sample_rate',
+		                      '-of', 'default=nw=1:nk=1', src], capture_output = True, text = True).stdout
+		return int(out.strip() or 44100)
+
+	def render(self, src, semitones):
+		out = self.variant_path(src, semitones)
+		tmp = out[:-4] + '.part.m4a'
+		ratio = 2 ** (semitones/12)
+		if self.has_rubberband():
+			af = f'rubberband=pitch={ratio:.6f}'
+		else:
+			sr = self.sample_rate(src)
+			af = f'asetrate={round(sr*ratio)},aresample={sr},atempo={1/ratio:.6f}'
+		cmd = ['ffmpeg', '-y', '-v', 'error', '-i', src, '-vn', '-af', af, '-c:a', 'aac', '-b:a', '160k', tmp]
+		if shutil.which('nice'):
+			cmd = ['nice', '-n', '19'] + cmd
+		ret = subprocess.run(cmd, stdin = subprocess.DEVNULL, capture_output = True, text = True)
+		if ret.returncode != 0 or not os.path.isfile(tmp):
+			logging.warning(f"Rendering {out} failed: {ret.stderr.strip()}")
+			if os.path.isfile(tmp):
+				os.remove(tmp)
+			return False
+		os.replace(tmp, out)
+		return True
+
+	def evict(self):
+		files = []
+		for bn in os.listdir(self.path):
+			if bn.endswith('.m4a') and not bn.endswith('.part.m4a'):
+				st = os.stat(os.path.join(self.path, bn))
+				files += [(st.st_mtime, st.st_size, bn)]
+		total = sum(size for _, size, _ in files)
+		for _, size, bn in sorted(files):
+			if total <= self.max_bytes:
+				break
+			os.remove(os.path.join(self.path, bn))
+			total -= size
+
+	def run(self):
+		while True:
+			with self.cond:
+				while not self.jobs:
+					self.cond.wait()
+				_, _, src, semitones = heapq.heappop(self.jobs)
+			try:
+				if os.path.isfile(src) and not os.path.isfile(self.variant_path(src, semitones)) and self.render(src, semitones):
+					self.evict()
+			except Exception as e:
+				logging.warning(f"Transposing {src} by {semitones} failed: {e}")
@@ -1,12 +1,16 @@
 import os, sys, re, random, shutil
-import string, logging, time
+import string, logging, time, socket, threading
 import subprocess, zipfile
 
 import requests
+import xml.etree.ElementTree as ET
+from requests.adapters import HTTPAdapter
+from collections import defaultdict
 
 from lib.get_platform import *
 from types import SimpleNamespace
 from html import unescape
+from urllib.parse import urlencode
 
 def get_default_vlc_path(platform):
 	shutil_path = shutil.which('cvlc') or shutil.which('vlc')
@@ -25,17 +29,87 @@ def get_default_vlc_path(platform):
 		return 'vlc'
 
 
+class VLCStatus:
+	"""Typed fields of one status.xml document, parsed in a single pass"""
+	fields = {'state': str, 'time': float, 'length': float, 'position': float, 'volume': float,
+	          'rate': float, 'audiodelay': float, 'subtitledelay': float}
+	invalid_chars = re.compile('[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]')
+
+	def __init__(self, xml = ''):
+		self.xml = xml
+		self.categories = {}	# 'meta', 'Stream 0', ... => {info name: value}
+		for key in self.fields:
+			setattr(self, key, None)
+		if not xml:
+			return
+		try:
+			# VLC copies control characters from tags into the document, which XML 1.0 does not allow
+			for el in ET.fromstring(self.invalid_chars.sub('', xml)):
+				if el.tag in self.fields:
+					self.set(el.tag, el.text)
+				elif el.tag == 'information':
+					self.categories = {cat.get('name'): {info.get('name'): (info.text or '').strip() for info in cat} for cat in el}
+		except ET.ParseError as e:
+			# malformed metadata should not hide the playback fields, the stream types or the filename
+			logging.debug(f"VLC status is not well-formed XML: {e}")
+			for key, val in re.findall(r'<(\w+)>([^<]*)</\1>', xml):
+				if key in self.fields:
+					self.set(key, unescape(val))
+			for name, body in re.findall(r'<category name=[\'"]([^\'"]*)[\'"]>(.*?)</category>', xml, re.S):
+				self.categories[unescape(name)] = {unescape(key): unescape(val).strip()
+				                                   for key, val in re.findall(r'<info name=[\'"]([^\'"]*)[\'"]>([^<]*)</info>', body)}
+
+	def set(self, key, val):
+		try:
+			setattr(self, key, self.fields[key](val))
+		except (TypeError, ValueError):
+			setattr(self, key, val)
+
+	@property
+	def stream_types(self):
+		return {info.get('Type') for info in self.categories.values()}
+
+	@property
+	def has_video(self):
+		return 'Video' in self.stream_types
+
+	@property
+	def has_audio(self):
+		return 'Audio' in self.stream_types
+
+	@property
+	def has_subtitle(self):
+		return 'Subtitle' in self.stream_types
+
+	@property
+	def filename(self):
+		# VLC escapes meta values once more on top of the XML escaping
+		name = self.categories.get('meta', {}).get('filename')
+		return None if name is None else unescape(name)
+
+	def as_dict(self):
+		return {key: getattr(self, key) for key in self.fields}
+
+
 class VLCClient:
 	vol_increment = 10
+	http_timeout = 2	# seconds, the HTTP interface is local so anything slower means VLC is stuck
+	startup_timeout = 20	# seconds for a new VLC process to open the media
+	max_backoff = 0.2	# seconds, cap of the readiness polling interval
 
-	def __init__(self, port = 5002, path = None, qrcode = None, url = None):
+	def __init__(self, port = 5002, path = None, qrcode = None, url = None, standby = False):
 
 		# HTTP remote control server
 		self.http_password = "".join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
 		self.port = port
 		self.http_endpoint = "http://localhost:%s/requests/status.xml" % self.port
 		self.http_command_endpoint = self.http_endpoint + "?command="
+		self.new_session()
+		self.latency = defaultdict(lambda: [0, 0.0, 0.0])	# command => [count, total_sec, max_sec]
 		self.is_transposing = False
+		self.standby = standby	# keep one VLC process and switch songs through its playlist
+		self.standby_params = []
+		self.preloaded = None	# (file_path, item options) waiting in the standby playlist
 
 		self.qrcode = qrcode
 		self.url = url
@@ -92,6 +166,22 @@ class VLCClient:
 		self.process = None
 		self.last_status_text = ""
 		self.last_status_time = time.time()
+		self.last_parsed = VLCStatus()
+		self.aborted = threading.Event()	# set by kill() to interrupt a pending startup
+		self.startup_latency = None
+
+	def new_session(self):
+		# keep-alive connections to VLC's HTTP interface, reused across commands
+		self.session = requests.Session()
+		self.session.auth = ("", self.http_password)
+		self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+
+	def record_latency(self, name, sec):
+		stat = self.latency[name]
+		stat[0], stat[1], stat[2] = stat[0]+1, stat[1]+sec, max(stat[2], sec)
+
+	def get_latency_stats(self):
+		return {cmd: {'count': n, 'avg_ms': round(tot/n*1000, 2), 'max_ms': round(mx*1000, 2)} for cmd, (n, tot, mx) in list(self.latency.items())}
 
 	def get_marquee_cmd(self):
 		return ["--sub-source", 'logo{file=%s,position=9,x=2,opacity=200}:marq{marquee="Pikaraoke - connect at: \n%s",position=9,x=38,color=0xFFFFFF,size=11,opacity=200}' % (self.qrcode, self.url)]
@@ -128,53 +218,110 @@ class VLCClient:
 		else:
 			return file_path
 
+	def build_command(self, params, files):
+		command = self.cmd_base + params + files
+		if self.platform == 'osx' and not os.K.full_screen:
+			command.remove('--fullscreen')
+			command.remove('--macosx-nativefullscreenmode')
+		if self.standby:
+			# stop after each song instead of exiting, the next one is started through the playlist
+			command[command.index('--play-and-exit')] = '--play-and-stop'
+		return command
+
+	def spawn(self, command):
+		self.session.close()	# pooled connections belong to the old VLC process
+		logging.info("VLC Command: %s" % command)
+		self.process = subprocess.Popen(command, stdin = subprocess.PIPE)
+
+	def start_standby(self, params = []):
+		# params are process-wide, e.g. the window to draw into, per-song options go with each playlist item
+		self.standby_params = params
+		self.is_transposing = True
+		self.spawn(self.build_command(params, []))
+		try:
+			self.wait_until(lambda: self.command("", False).status_code == 200, time.time()+self.startup_timeout, 'HTTP interface ready')
+		except Exception as e:
+			logging.error("Starting standby VLC failed: " + str(e))
+		self.is_transposing = False
+
+	@staticmethod
+	def item_options(params):
+		# command line options as playlist item options, e.g. ['--rate=1.1', '--pitch-shift', '-2'] => [':rate=1.1', ':pitch-shift=-2']
+		opts, ii = [], 0
+		while ii < len(params):
+			opt = params[ii]
+			if '=' not in opt and ii+1 < len(params) and not params[ii+1].startswith('--'):
+				opt, ii = opt + '=' + params[ii+1], ii+1
+			opts.append(':' + opt.lstrip('-'))
+			ii += 1
+		return opts
+
+	def input_command(self, command, file_path, options):
+		return command + '&' + urlencode([('input', file_path)] + [('option', opt) for opt in options])
+
+	def preload(self, file_path, params = []):
+		# enqueue the next song while the splash screen is shown, so that starting it skips process startup
+		if not self.standby or not self.process_alive() or self.is_running() or file_path.lower().endswith('.zip'):
+			return
+		options = self.item_options(params)
+		if self.preloaded != (file_path, options):
+			self.command("pl_empty", False)
+			self.command(self.input_command('in_enqueue', file_path, options), False)
+			self.preloaded = (file_path, options)
+
 	def play_file(self, file_path, volume, params = []):
 		try:
 			file_path = self.process_file(file_path)
 			self.is_transposing = True
-			if self.process is not None and self.process.poll() is None:
-				logging.debug("VLC is currently playing, stopping track...")
-				# must wait for VLC to quit or force kill, otherwise VLC http server will be borked
-				try:
-					self.stop()
-					self.process.wait(2)
-				except:
-					self.process.kill()
-			command = self.cmd_base + params + [file_path]
-			if self.platform == 'osx' and not os.K.full_screen:
-				command.remove('--fullscreen')
-				command.remove('--macosx-nativefullscreenmode')
-			logging.info("VLC Command: %s" % command)
-
-			self.process = subprocess.Popen(command, stdin = subprocess.PIPE)
-
-			# wait for the process to start
-			while self.process.poll() is not None:
-				pass
-
-			# wait for VLC HTTP is ready
-			while True:
-				time.sleep(0.1)
+			self.aborted.clear()
+			tm = time.time()
+			if self.standby:
+				if not self.process_alive():
+					self.start_standby(self.standby_params)
+					self.is_transposing = True
+				tm = time.time()
+				options = self.item_options(params)
+				if self.preloaded == (file_path, options):
+					self.command("pl_play", False)
+				else:
+					self.command("pl_empty", False)
+					self.command(self.input_command('in_play', file_path, options), False)
+				self.preloaded = None
+				logging.info(f"VLC switched to {file_path} with options {options}")
+			else:
+				if self.process_alive():
+					logging.debug("VLC is currently playing, stopping track...")
+					# must wait for VLC to quit or force kill, otherwise VLC http server will be borked
+					try:
+						self.stop()
+						self.process.wait(2)
+					except:
+						self.process.kill()
+				self.spawn(self.build_command(params, [file_path]))
+			deadline = tm + self.startup_timeout
+
+			# wait for VLC HTTP to be ready and the new media to be opened
+			def media_opened():
 				req = self.command("", False)
-				xml = req.text
-				if "<info name='Type'>Video</info>" not in xml and "<info name='Type'>Audio</info>" not in xml:
-					pass
-				elif req.status_code == 200:
-					break
+				status = self.parse(req.text)
+				return req.status_code == 200 and (status.has_video or status.has_audio) \
+					and status.filename in (None, os.path.basename(file_path)) and req.text
+			xml = self.wait_until(media_opened, deadline, 'media opened')
 
 			# workaround --volume-save not working in Windows
-			okay = False
-			while volume and not okay:
-				try:
-					volume = round(volume)
-					xml = self.command(f"volume&val={volume}", False).text
-					if int(self.get_val_xml(xml, 'volume')) == volume:
-						okay = True
-					if not os.K.is_paused and self.get_val_xml(xml, 'state') != 'playing':
-						okay = False
-				except:
-					time.sleep(0.1)
-
+			def volume_set():
+				xml = self.command(f"volume&val={round(volume)}", False).text
+				status = self.parse(xml)
+				okay = status.volume is not None and int(status.volume) == round(volume)
+				return okay and (os.K.is_paused or status.state == 'playing') and xml
+			if volume:
+				xml = self.wait_until(volume_set, deadline, 'volume set')
+
+			self.startup_latency = time.time() - tm
+			self.record_latency('startup', self.startup_latency)
+			logging.info(f"VLC startup latency: {self.startup_latency:.3f}s")
+			# the throttled status cache still shows the previous song, e.g. 'stopped' in standby
+			self.last_status_text, self.last_status_time = xml, time.time()
 			self.is_transposing = False
 			return xml
 
@@ -182,6 +329,25 @@ class VLCClient:
 			logging.error("Playing file failed: " + str(e))
 			self.is_transposing = False
 
+	def wait_until(self, check, deadline, what):
+		# polls check() with exponential backoff until it returns something truthy, the VLC process exits,
+		# the deadline passes or kill() is called
+		delay = 0.02
+		while True:
+			if self.process.poll() is not None:
+				raise RuntimeError(f"VLC exited with code {self.process.returncode} before {what}")
+			try:
+				res = check()
+			except Exception:
+				res = None
+			if res:
+				return res
+			if time.time() + delay > deadline:
+				raise TimeoutError(f"VLC startup timed out before {what}")
+			if self.aborted.wait(delay):
+				raise RuntimeError(f"VLC was killed before {what}")
+			delay = min(delay*2, self.max_backoff)
+
 	def play_file_transpose(self, file_path, semitones, volume, extra_params = []):
 		# --speex-resampler-quality=<integer [0 .. 10]>
 		#  Resampling quality (0 = worst and fastest, 10 = best and slowest).
@@ -216,20 +382,23 @@ class VLCClient:
 
 	def command(self, command = '', save_status=True):
 		try:
-			self.last_status_time = time.time()
-			if not self.is_running():
+			if save_status:
+				self.last_status_time = time.time()
+			if not self.process_alive() and not self.is_transposing:
 				return SimpleNamespace(**{'text': self.last_status_text, 'status_code': 500})
 			url = self.http_command_endpoint + command
-			request = requests.get(url, auth = ("", self.http_password))
+			tm = time.time()
+			request = self.session.get(url, timeout = self.http_timeout)
+			self.record_latency(command.split('&')[0] or 'status', time.time()-tm)
 			if self.is_transposing and save_status:
 				return SimpleNamespace(**{'text': self.last_status_text, 'status_code': request.status_code})
 			if save_status:
 				self.last_status_text = request.text
-				os.K.has_video = "<info name='Type'>Video</info>" in request.text
-			if not os.K.now_playing:
+				os.K.has_video = self.parse(request.text).has_video
+			if not os.K.now_playing and not self.standby:
 				# by right, here should never be reached
 				request.encoding = 'utf-8'
-				os.K.now_playing_filename = unescape(unescape(self.get_val_xml(request.text, "info name='filename'")))
+				os.K.now_playing_filename = self.parse(request.text).filename
 				if not os.path.isfile(os.K.now_playing_filename):
 					os.K.now_playing_filename = os.K.download_path + os.K.now_playing_filename
 				os.K.now_playing = os.K.filename_from_path(os.K.now_playing_filename)
@@ -244,52 +413,49 @@ class VLCClient:
 	def play(self):
 		return self.command("pl_play")
 
-	def get_val_xml(self, xml, key, end_key_str= '<'):
-		posi = xml.find(f'<{key}>')
-		if posi < 0:
-			return None
-		s = xml[posi+len(key)+2:]
-		posi = s.find(end_key_str)
-		if posi < 0:
-			return None
-		return s[:posi]
+	def parse(self, xml):
+		# the same status document is typically read several times, parse it only once
+		if xml is not self.last_parsed.xml and xml != self.last_parsed.xml:
+			self.last_parsed = VLCStatus(xml or '')
+		return self.last_parsed
 
-	def cast_float(self, num):
-		try:
-			return float(num)
-		except:
-			return num
+	def get_status_info(self):
+		return self.parse(self.get_status())
 
 	def get_info_xml(self, xml=None):
-		try:
-			if xml is None:
-				xml = self.get_status()
-			return {key: self.cast_float(self.get_val_xml(xml, key)) for key in ['position', 'length', 'volume', 'time', 'audiodelay', 'state', 'subtitledelay', 'rate']}
-		except:
-			return {}
-
-	def parse_category(self, xml):
-		extract = lambda t: t[:min([t.find(c) for c in ['"', "'"] if c in t])]
-		try:
-			xml = xml.strip()
-			name = extract(xml[16:])
-			infos = {}
-			while '<info ' in xml:
-				p_start = xml.find('<info ')
-				p_end = xml.find('</info>')
-				s1 = extract(xml[p_start+12:])
-				infos[s1] = xml[xml.find('>', p_start)+1: p_end].strip()
-				xml = xml[p_end+7:]
-			return {name: infos}
-		except:
-			return {}
+		return self.parse(self.get_status() if xml is None else xml).as_dict()
 
 	def get_stream_info(self, xml):
-		try:
-			info = self.get_val_xml(xml, 'information', '</information>').strip()
-			return {k: v for L in info.split('</category>') for k, v in self.parse_category(L).items()}
-		except:
-			return {}
+		return self.parse(xml).categories
+
+	track_commands = {'Audio': 'audio_track', 'Video': 'video_track', 'Subtitle': 'subtitle_track'}
+	# whether selected_track() can confirm a switch, the HTTP status does not show the selected track
+	tracks_verifiable = False
+
+	def stream_ids(self, kind):
+		# ids of the 'Audio'/'Video'/'Subtitle' streams of the running media, from the stream info categories;
+		# the 'Stream N' titles and Type values are localized and N is not guaranteed to be the ES id
+		categories = self.parse(self.command().text).categories
+		return sorted(int(name.split()[-1]) for name, info in categories.items() if info.get('Type') == kind and name.split()[-1].isdigit())
+
+	def selected_track(self, kind):
+		return None
+
+	def set_track(self, kind, es_id):
+		"""Switches tracks without reopening the media, es_id -1 disables the stream kind
+
+		True only if the switch is confirmed by selected_track(), VLC answers 200 to any id. Without a way to
+		confirm it nothing is sent, and callers reopen the media with the track as an option instead.
+		"""
+		if not self.tracks_verifiable:
+			return False
+		self.command(f"{self.track_commands[kind]}&val={es_id}")
+		# the input thread applies the selection asynchronously
+		for delay in [0, 0.05, 0.1, 0.2]:
+			time.sleep(delay)
+			if self.selected_track(kind) == es_id:
+				return True
+		return False
 
 	def seek(self, seek_sec):
 		return self.command(f"seek&val={seek_sec}")
@@ -320,28 +486,31 @@ class VLCClient:
 		return self.command(f"rate&val={value}")
 
 	def kill(self):
+		self.aborted.set()
 		try:
 			if self.process is not None: self.process.kill()
 		except (OSError, AttributeError) as e:
 			print(e)
 		return
 
+	def process_alive(self):
+		return self.process != None and self.process.poll() == None
+
 	def is_running(self):
-		return (self.process != None and self.process.poll() == None) or self.is_transposing
+		# a standby VLC outlives its songs, it counts as running while a song is loaded
+		if self.standby and not self.is_transposing:
+			return self.process_alive() and self.get_status_info().state in ('playing', 'paused')
+		return self.process_alive() or self.is_transposing
 
 	def is_playing(self):
 		if self.is_running():
-			status = self.get_status()
-			state = self.get_val_xml(status, 'state')
-			return state == "playing"
+			return self.get_status_info().state == "playing"
 		else:
 			return False
 
 	def is_paused(self):
 		if self.is_running():
-			status = self.get_status()
-			state = self.get_val_xml(status, 'state')
-			return state == "paused"
+			return self.get_status_info().state == "paused"
 		else:
 			return False
 
@@ -363,6 +532,142 @@ class VLCClient:
 		except KeyboardInterrupt:
 			self.kill()
 
+class VLCRCClient(VLCClient):
+	"""VLCClient sending player commands and status queries over VLC's RC (oldrc) interface
+
+	The RC connection is a persistent local socket, a Unix socket except on Windows. The HTTP interface
+	stays enabled for startup, stream information and the commands oldrc lacks (audio/subtitle delays).
+	"""
+	rc_commands = {'': None, 'pl_pause': 'pause', 'pl_play': 'play', 'pl_stop': 'stop', 'seek': 'seek', 'volume': 'volume', 'rate': 'rate',
+	               'audio_track': 'atrack', 'video_track': 'vtrack', 'subtitle_track': 'strack'}
+
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		os.makedirs(self.tmp_dir, exist_ok = True)
+		if self.platform == 'windows':
+			self.rc_addr = ('localhost', int(self.port)+1)
+			rc_params = ['--rc-host', 'localhost:%s' % (int(self.port)+1), '--rc-quiet']
+		else:
+			self.rc_addr = os.path.join(self.tmp_dir, 'vlc-rc-%s.sock' % self.port)
+			rc_params = ['--rc-unix', self.rc_addr, '--rc-fake-tty']
+		ii = self.cmd_base.index('--extraintf')
+		self.cmd_base[ii+1] = 'http:oldrc'
+		self.cmd_base[ii+2:ii+2] = rc_params
+		logging.info("VLC RC control: %s" % (self.rc_addr,))
+		self.rc_sock = None
+		self.rc_lock = threading.Lock()
+		self.http_status = VLCStatus()	# last status fetched over HTTP, for stream info and delays
+		self.rc_status_cache = VLCStatus()
+		self.rate = 1.0
+
+	def rc_close(self):
+		if self.rc_sock is not None:
+			try:
+				self.rc_sock.close()
+			except OSError:
+				pass
+			self.rc_sock = None
+
+	def rc_read(self):
+		# every response ends with the '> ' prompt
+		buf = b''
+		while not buf.endswith(b'> '):
+			chunk = self.rc_sock.recv(4096)
+			if not chunk:
+				raise ConnectionError('VLC closed the RC connection')
+			buf += chunk
+		return buf[:-2].decode('utf-8', 'replace').strip()
+
+	def rc(self, cmd):
+		with self.rc_lock:
+			tm = time.time()
+			try:
+				if self.rc_sock is None:
+					self.rc_sock = socket.socket(socket.AF_INET if type(self.rc_addr) == tuple else socket.AF_UNIX)
+					self.rc_sock.settimeout(self.http_timeout)
+					self.rc_sock.connect(self.rc_addr)
+					self.rc_read()	# greeting
+				self.rc_sock.sendall(cmd.encode('utf-8') + b'\n')
+				res = self.rc_read()
+			except OSError:
+				self.rc_close()
+				raise
+			self.record_latency('rc ' + cmd.split(' ')[0], time.time()-tm)
+			return res
+
+	def rc_status(self):
+		st = VLCStatus()
+		st.categories = self.http_status.categories
+		st.audiodelay, st.subtitledelay, st.rate = self.http_status.audiodelay, self.http_status.subtitledelay, self.rate
+		status = self.rc('status')
+		m = re.search(r'\( audio volume: ([\d.]+) \)', status)
+		st.volume = float(m.group(1)) if m else None
+		m = re.search(r'\( state (\w+) \)', status)
+		st.state = m.group(1) if m else 'stopped'
+		st.set('time', self.rc('get_time') or None)
+		st.set('length', self.rc('get_length') or None)
+		st.position = st.time/st.length if st.time is not None and st.length else 0.0
+		# a compact document standing for this status, parse() maps it back without re-parsing
+		st.xml = '<root>%s</root>' % ''.join('<%s>%s</%s>' % (k, v, k) for k, v in st.as_dict().items() if v is not None)
+		self.rc_status_cache = st
+		return st
+
+	tracks_verifiable = True
+
+	def rc_tracks(self, kind):
+		# oldrc lists the real ES ids and stars the selected one, e.g. '| 3 - Track 2 - [English] *', or '| -1 - Disable'
+		out = self.rc(self.rc_commands[self.track_commands[kind]]).replace('\r', '')
+		return [(int(es_id), bool(star)) for es_id, star in re.findall(r'^\| (-?\d+) - .*?( \*)?$', out, re.M)]
+
+	def stream_ids(self, kind):
+		try:
+			return [es_id for es_id, _ in self.rc_tracks(kind) if es_id >= 0]
+		except OSError:
+			return super().stream_ids(kind)
+
+	def selected_track(self, kind):
+		try:
+			return next((es_id for es_id, selected in self.rc_tracks(kind) if selected), None)
+		except OSError:
+			return None
+
+	def parse(self, xml):
+		if xml == self.rc_status_cache.xml and xml:
+			return self.rc_status_cache
+		return super().parse(xml)
+
+	def command(self, command = '', save_status = True):
+		name, _, val = command.partition('&val=')
+		if self.is_transposing or name not in self.rc_commands or not self.process_alive():
+			req = super().command(command, save_status)
+			if req.status_code == 200:
+				self.http_status = self.parse(req.text)
+				self.rate = self.http_status.rate or self.rate
+			return req
+		try:
+			if name == 'volume' and val[:1] in ('+', '-'):
+				val = str(max(0, round((self.rc_status().volume or 0) + int(val))))
+			if name:
+				self.rc(f'{self.rc_commands[name]} {val}'.strip())
+			if name == 'rate':
+				self.rate = float(val)
+			st = self.rc_status()
+		except (OSError, ValueError) as e:
+			logging.warning(f"VLC RC command '{command}' failed, falling back to HTTP: {e}")
+			return super().command(command, save_status)
+		if save_status:
+			self.last_status_text, self.last_status_time = st.xml, time.time()
+		return SimpleNamespace(**{'text': st.xml, 'status_code': 200})
+
+	def spawn(self, command):
+		# the new VLC process listens on a fresh RC socket
+		self.rc_close()
+		if type(self.rc_addr) == str and os.path.exists(self.rc_addr):
+			os.remove(self.rc_addr)
+		self.rate = 1.0
+		super().spawn(command)
+
+
 # if __name__ == "__main__":
 #     k = VLCClient()
 #     k.play_file("/path/to/file.mp4")
@@ -0,0 +1,148 @@
+import os, json, time, socket, sqlite3, threading
+
+NOW_PLAYING, QUEUED, BACKFILL = 0, 1, 2
+WAKEUP_PORT = 5004	# UDP port on localhost the vocal splitter listens on for new jobs
+
+
+def output_name(basename, use_DNN):
+	# stereo-subtraction outputs are hidden dot files next to the DNN ones
+	return ('' if use_DNN else '.') + basename + '.m4a'
+
+
+def partial_paths(track):
+	"""(growing ADTS file, progress sidecar) written next to a vocal/nonvocal .m4a while it is being separated"""
+	stem = track[:-len('.m4a')]
+	return stem + '.partial.aac', stem + '.partial.json'
+
+
+def write_progress(sidecar, **progress):
+	# seconds separated so far, duration of the song (or None), started/updated timestamps, interval of the last update
+	with open(sidecar + '.tmp', 'w') as fp:
+		json.dump(progress, fp)
+	os.replace(sidecar + '.tmp', sidecar)
+
+
+def partial_ready(track, position, lead_sec):
+	"""Whether the partial of a track still being separated can be played from `position` seconds without running dry
+
+	A separation running at `rate` times real time falls behind playback by (1/rate - 1) seconds per second
+	of remaining audio, the part already separated must cover that plus lead_sec.
+	"""
+	partial, sidecar = partial_paths(track)
+	try:
+		with open(sidecar) as fp:
+			prog = json.load(fp)
+	except (OSError, ValueError):
+		return False
+	# a splitter that died mid-song leaves a sidecar that is no longer updated
+	if not os.path.isfile(partial) or time.time() - prog['updated'] > 60 + 3*prog['interval']:
+		return False
+	rate = prog['seconds'] / max(prog['updated'] - prog['started'], 1e-3)
+	needed = lead_sec
+	if rate < 1:
+		remaining = prog['duration'] - prog['seconds'] if prog['duration'] else float('inf')
+		needed += max(remaining, 0) * (1/max(rate, 1e-3) - 1)
+	return prog['seconds'] - position >= needed
+
+
+def missing_outputs(song_path, basenames, use_DNN):
+	"""Basenames whose vocal/nonvocal tracks are not there yet, long lists take one listdir per output directory"""
+	dirs = [d for d in [os.path.join(song_path, 'nonvocal'), os.path.join(song_path, 'vocal')] if os.path.isdir(d)]
+	if len(basenames) > 32:
+		listed = [set(os.listdir(d)) for d in dirs]
+		has = lambda ii, fn: fn in listed[ii]
+	else:
+		has = lambda ii, fn: os.path.isfile(os.path.join(dirs[ii], fn))
+	return [bn for bn in basenames if not all(has(ii, output_name(bn, use_DNN)) for ii in range(len(dirs)))]
+
+
+class VocalJobQueue:
+	"""Vocal-splitting jobs shared by PiKaraoke and vocal_splitter.py in an SQLite file
+
+	The lowest priority value is claimed first (now playing, then queued, then library backfill), a job pushed
+	again keeps its most urgent priority. Pushing sends a UDP datagram to the splitter, which listen()s
+	and blocks in wait() instead of polling. Jobs left 'running' by a killed splitter are reset by reset_running().
+	"""
+
+	def __init__(self, db_path, wakeup_port = WAKEUP_PORT):
+		self.wakeup_port = wakeup_port
+		self.lock = threading.Lock()
+		self.sock = None
+		self.db = sqlite3.connect(db_path, timeout = 30, check_same_thread = False, isolation_level = None)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute("CREATE TABLE IF NOT EXISTS jobs (basename TEXT, use_dnn INTEGER, priority INTEGER, "
+		                "state TEXT DEFAULT 'todo', added REAL, PRIMARY KEY (basename, use_dnn))")
+		self.db.execute('CREATE INDEX IF NOT EXISTS jobs_order ON jobs (state, priority, added)')
+
+	def push(self, basenames, priority, use_DNN):
+		rows = [(bn, int(use_DNN), priority, time.time()) for bn in basenames]
+		if not rows:
+			return
+		with self.lock:
+			self.db.execute('BEGIN IMMEDIATE')
+			self.db.executemany('INSERT INTO jobs (basename, use_dnn, priority, added) VALUES (?, ?, ?, ?) '
+			                    'ON CONFLICT (basename, use_dnn) DO UPDATE SET priority=min(priority, excluded.priority)', rows)
+			self.db.execute('COMMIT')
+		self.notify()
+
+	def demote(self, priority, to_priority):
+		"""Move jobs more urgent than `to_priority` down to it, e.g. songs no longer queued back to backfill"""
+		with self.lock:
+			self.db.execute('UPDATE jobs SET priority=? WHERE priority>=? AND priority<?', (to_priority, priority, to_priority))
+
+	def claim(self):
+		"""(basename, use_DNN, priority) of the most urgent job, marked running, or None"""
+		with self.lock:
+			self.db.execute('BEGIN IMMEDIATE')
+			row = self.db.execute("SELECT basename, use_dnn, priority FROM jobs WHERE state='todo' ORDER BY priority, added LIMIT 1").fetchone()
+			if row:
+				self.db.execute("UPDATE jobs SET state='running' WHERE basename=? AND use_dnn=?", row[:2])
+			self.db.execute('COMMIT')
+		return None if row is None else (row[0], bool(row[1]), row[2])
+
+	def done(self, basename, use_DNN):
+		with self.lock:
+			self.db.execute('DELETE FROM jobs WHERE basename=? AND use_dnn=?', (basename, int(use_DNN)))
+
+	def rename(self, old_basename, new_basename):
+		with self.lock:
+			self.db.execute("UPDATE OR REPLACE jobs SET basename=? WHERE basename=? AND state='todo'", (new_basename, old_basename))
+
+	def cancel(self, use_DNN):
+		# pending jobs of a splitting mode that is no longer selected
+		with self.lock:
+			self.db.execute("DELETE FROM jobs WHERE use_dnn=? AND state='todo'", (int(use_DNN),))
+
+	def reset_running(self):
+		with self.lock:
+			self.db.execute("UPDATE jobs SET state='todo' WHERE state='running'")
+
+	def pending(self):
+		with self.lock:
+			return self.db.execute("SELECT count(*) FROM jobs WHERE state='todo'").fetchone()[0]
+
+	def notify(self):
+		try:
+			with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+				s.sendto(b'job', ('127.0.0.1', self.wakeup_port))
+		except OSError:
+			pass
+
+	def listen(self):
+		# bind before the first claim(), so that a job pushed in between still wakes up wait()
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.bind(('127.0.0.1', self.wakeup_port))
+
+	def wait(self, timeout = None):
+		"""Block until notify() is called (from any process) or timeout"""
+		if self.sock is None:
+			self.listen()
+		self.sock.settimeout(timeout)
+		try:
+			self.sock.recv(64)
+			# coalesce a burst of notifications into one wakeup
+			self.sock.setblocking(False)
+			while True:
+				self.sock.recv(64)
+		except (socket.timeout, BlockingIOError):
+			pass
@@ -0,0 +1,91 @@
+import os, json, gzip, hashlib, logging, sqlite3, threading
+
+
+class VolumeStore:
+	"""SQLite store of per-song loudness, validated by stat instead of hashing the whole file
+
+	An entry is valid while the file's size, mtime and inode are unchanged. If only mtime or inode changed
+	(copied or restored files), a hash of a few sampled blocks decides, and the stat fields are refreshed.
+	"""
+	sample_size = 1<<16
+	sample_blocks = 4
+
+	def __init__(self, db_path, legacy_json = None, sample_hash = True):
+		self.sample_hash = sample_hash
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(db_path, check_same_thread = False)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('CREATE TABLE IF NOT EXISTS volumes (basename TEXT PRIMARY KEY, volume REAL, lufs REAL, '
+		                'size INTEGER, mtime REAL, inode INTEGER, sample_hash TEXT, md5 TEXT)')
+		self.db.commit()
+		if legacy_json and os.path.isfile(legacy_json) and not self.db.execute('SELECT 1 FROM volumes LIMIT 1').fetchone():
+			self.migrate(legacy_json)
+
+	def migrate(self, legacy_json):
+		# entries of the old gzip'd JSON are [volume, size, md5(, lufs)], checked once by md5 and then by stat
+		try:
+			with gzip.open(legacy_json, 'rt', encoding = 'utf-8') as fp:
+				song2vol = json.load(fp)
+			rows = [(bn, v[0], v[3] if len(v) > 3 else None, v[1], v[2]) for bn, v in song2vol.items()]
+			with self.lock, self.db:
+				self.db.executemany('INSERT OR REPLACE INTO volumes (basename, volume, lufs, size, md5) VALUES (?, ?, ?, ?, ?)', rows)
+			logging.info(f"Migrated {len(rows)} loudness entries from {legacy_json}")
+		except Exception as e:
+			logging.warning(f"Failed to migrate {legacy_json}: {e}")
+
+	def hash_samples(self, filename, size):
+		md5 = hashlib.md5(str(size).encode())
+		with open(filename, 'rb') as fp:
+			for ii in range(self.sample_blocks):
+				fp.seek(max(0, (size-self.sample_size) * ii // max(1, self.sample_blocks-1)))
+				md5.update(fp.read(self.sample_size))
+		return md5.hexdigest()
+
+	def full_md5(self, filename):
+		md5 = hashlib.md5()
+		with open(filename, 'rb') as fp:
+			for chunk in iter(lambda: fp.read(1<<20), b''):
+				md5.update(chunk)
+		return md5.hexdigest()
+
+	def known(self):
+		with self.lock:
+			return {bn for bn, in self.db.execute('SELECT basename FROM volumes')}
+
+	def get(self, filename, verify_md5 = False):
+		"""The stored volume if it is still valid for the file, else None
+
+		Entries migrated with only an md5 need a full read of the file, that is left to callers
+		off the playback path (verify_md5=True), otherwise they count as unknown.
+		"""
+		basename, st = os.path.basename(filename), os.stat(filename)
+		with self.lock:
+			row = self.db.execute('SELECT volume, size, mtime, inode, sample_hash, md5 FROM volumes WHERE basename=?', (basename,)).fetchone()
+		if row is None or row[1] != st.st_size:
+			return None
+		volume, _, mtime, inode, sample_hash, md5 = row
+		if mtime == st.st_mtime and inode == st.st_ino:
+			return volume
+		if sample_hash and self.sample_hash:
+			valid = sample_hash == self.hash_samples(filename, st.st_size)
+		elif md5 and verify_md5:
+			valid = md5 == self.full_md5(filename)
+		else:
+			valid = False
+		if valid:
+			self.update_stat(basename, st, filename)
+			return volume
+		return None
+
+	def update_stat(self, basename, st, filename):
+		sample_hash = self.hash_samples(filename, st.st_size) if self.sample_hash else None
+		with self.lock, self.db:
+			self.db.execute('UPDATE volumes SET mtime=?, inode=?, sample_hash=?, md5=NULL WHERE basename=?',
+			                (st.st_mtime, st.st_ino, sample_hash, basename))
+
+	def put(self, filename, volume, lufs = None):
+		st = os.stat(filename)
+		sample_hash = self.hash_samples(filename, st.st_size) if self.sample_hash else None
+		with self.lock, self.db:
+			self.db.execute('INSERT OR REPLACE INTO volumes VALUES (?, ?, ?, ?, ?, ?, ?, NULL)',
+			                (os.path.basename(filename), float(volume), lufs, st.st_size, st.st_mtime, st.st_ino, sample_hash))
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+# Compare the command latency of VLC's HTTP and RC control interfaces
+# Usage: python3 scripts/vlc_control_bench.py <media_file> [rounds]
+
+import os, sys, time, json
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lib.vlcclient import VLCClient, VLCRCClient
+
+
+def bench(client, media, rounds):
+	client.play_file(media, 0)
+	time.sleep(1)
+	tm = time.time()
+	for ii in range(rounds):
+		client.command()
+		client.vol_set(200 + ii%2*10)
+		client.seek(ii%10)
+	total = time.time() - tm
+	client.stop()
+	client.kill()
+	return total
+
+
+if __name__ == '__main__':
+	media, rounds = sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 100
+	# VLCClient reads a few fields of the running Karaoke instance
+	os.K = SimpleNamespace(is_paused = False, has_video = False, now_playing = os.path.basename(media),
+	                       now_playing_filename = media, full_screen = False)
+	for name, cls in [('http', VLCClient), ('rc', VLCRCClient)]:
+		client = cls()
+		total = bench(client, media, rounds)
+		print(f'{name}: {rounds} rounds of status+volume+seek in {total:.3f}s, {total/rounds/3*1000:.2f} ms per command')
+		print(json.dumps(client.get_latency_stats(), indent = 1))
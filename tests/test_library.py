@@ -0,0 +1,21 @@
+import os, sys
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('unidecode')
+from lib.library import SongLibrary
+
+
+def test_songname_trans_stays_sorted(tmp_path):
+	path = str(tmp_path) + '/'
+	for bn in ['b.mp4', '1 intro.mp4', 'c.mp4']:
+		open(path+bn, 'w').close()
+	lib = SongLibrary(path, ['.mp4'], lambda fn: os.path.basename(fn)[:-4])
+	lib.scan()
+	open(path+'a.mp4', 'w').close()
+	lib.add(path+'a.mp4')
+	assert list(lib.sorted_trans.items()) == [(path+'1 intro.mp4', '1 intro'), (path+'a.mp4', 'a'), (path+'b.mp4', 'b'), (path+'c.mp4', 'c')]
+	assert list(lib.sorted_trans) == lib.songs
+	lib.remove(path+'b.mp4')
+	assert [fn for fn, trans in lib.sorted_trans.items() if trans.startswith('b')] == []
+	assert lib.sorted_trans[path+'c.mp4'] == 'c' and len(lib.sorted_trans) == 3
@@ -0,0 +1,64 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.search import NgramIndex, substring_distance
+
+
+TITLES = ['bohemian rhapsody', 'yesterday', 'hotel california', 'imagine', 'hey jude', 'let it be',
+          'hotline bling', 'shape of you', 'bohemian like you', 'yellow submarine']
+
+
+def make_index(n = 3):
+	ix = NgramIndex(n)
+	for ii, title in enumerate(TITLES):
+		ix.add(ii, title)
+	return ix
+
+
+def titles(res):
+	return [TITLES[key] for _, key in res]
+
+
+def test_substring_distance():
+	assert substring_distance('hotel', 'the hotel california') == 0
+	assert substring_distance('hotl', 'hotel california') == 1
+	assert substring_distance('xyz', 'hotel', 1) is None
+
+
+def test_fuzzy_transposition():
+	# 8 characters with two letters swapped, too short for the q-gram bound of the trigram index
+	assert titles(make_index().fuzzy('bohemain'))[0] == 'bohemian rhapsody'
+	assert titles(make_index().fuzzy('yestrday'))[0] == 'yesterday'
+
+
+def test_fuzzy_short_query():
+	assert 'hotel california' in titles(make_index().fuzzy('hotl'))
+
+
+def test_fuzzy_long_query():
+	assert titles(make_index().fuzzy('hotel califronia'))[0] == 'hotel california'
+
+
+def test_fuzzy_no_match():
+	assert make_index().fuzzy('zzzzzzzz') == []
+	assert make_index().fuzzy('zz') == []
+
+
+def test_search_exact():
+	ix = make_index()
+	assert [TITLES[k] for k in ix.search('hot')] == ['hotline bling', 'hotel california']
+	ix.remove(2)
+	assert [TITLES[k] for k in ix.search('hot')] == ['hotline bling']
+
+
+def test_fuzzy_skips_common_grams():
+	# 'hot' is in every title, it is left uncounted and the bound is lowered instead
+	ix = NgramIndex(3)
+	ix.rebuild(enumerate(['hot stuff %d' % ii for ii in range(100)] + ['hotel california']))
+	assert ix.texts[ix.fuzzy('hotel califronia', max_postings = 50)[0][1]] == 'hotel california'
+
+
+def test_search_stops_at_limit_prefix_matches():
+	ix = NgramIndex(3)
+	ix.rebuild(enumerate(['the love song', 'love me do', 'love story', 'lovely day']))
+	assert [ix.texts[k] for k in ix.search('love', 2)] == ['love me do', 'love story']
@@ -0,0 +1,104 @@
+import os, sys, socket, threading
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('requests')
+from lib.vlcclient import VLCRCClient
+
+pytestmark = pytest.mark.skipif(not hasattr(socket, 'AF_UNIX'), reason = 'the fake oldrc server listens on a Unix socket')
+
+
+class FakeRC:
+	"""Just enough of VLC's oldrc interface: a greeting, '\\r\\n' line ends with --rc-fake-tty and the '> ' prompt
+	after every response, sent in small chunks to exercise the prompt framing"""
+	tracks = {-1: 'Disable', 1: 'Track 1 - [English]', 3: 'Track 2 - [Japanese]'}
+
+	def __init__(self, path):
+		self.selected, self.received = 1, []
+		self.server = socket.socket(socket.AF_UNIX)
+		self.server.bind(path)
+		self.server.listen(1)
+		threading.Thread(target = self.serve, daemon = True).start()
+
+	def reply(self, conn, text):
+		data = (text.replace('\n', '\r\n') + ('\r\n' if text else '') + '> ').encode()
+		for ii in range(0, len(data), 7):
+			conn.sendall(data[ii:ii+7])
+
+	def respond(self, cmd):
+		name, _, val = cmd.partition(' ')
+		if name == 'atrack' and val:
+			if int(val) in self.tracks:
+				self.selected = int(val)
+			return ''
+		if name == 'atrack':
+			return '\n'.join(['+----[ Audio Track ]'] + [f'| {es_id} - {title}' + (' *' if es_id == self.selected else '')
+			                                             for es_id, title in self.tracks.items()] + ['+----[ end of Audio Track ]'])
+		return {'status': '( audio volume: 256 )\n( state playing )', 'get_time': '12', 'get_length': '200', 'quit': None}.get(name, '')
+
+	def serve(self):
+		conn, _ = self.server.accept()
+		with conn:
+			self.reply(conn, 'VLC media player 3.0.20 Vetinari\nCommand Line Interface initialized. Type `help\' for help.')
+			buf = b''
+			while True:
+				chunk = conn.recv(4096)
+				if not chunk:
+					return
+				buf += chunk
+				while b'\n' in buf:
+					line, buf = buf.split(b'\n', 1)
+					self.received.append(line.decode())
+					res = self.respond(line.decode())
+					if res is None:
+						return
+					self.reply(conn, res)
+
+
+@pytest.fixture
+def client(tmp_path):
+	k = VLCRCClient(port = 5999)
+	k.rc_addr = str(tmp_path/'rc.sock')
+	k.process_alive = lambda: True
+	yield k
+	k.rc_close()
+
+
+def test_rc_reads_up_to_the_prompt(client):
+	server = FakeRC(client.rc_addr)
+	assert client.rc('get_time') == '12'
+	assert client.rc('status') == '( audio volume: 256 )\r\n( state playing )'
+	assert server.received == ['get_time', 'status']
+	assert client.get_latency_stats()['rc get_time']['count'] == 1
+
+
+def test_stream_ids_and_selected_track(client):
+	FakeRC(client.rc_addr)
+	assert client.stream_ids('Audio') == [1, 3]
+	assert client.selected_track('Audio') == 1
+
+
+def test_set_track_is_confirmed(client):
+	server = FakeRC(client.rc_addr)
+	assert client.set_track('Audio', 3)
+	assert 'atrack 3' in server.received and server.selected == 3
+	# VLC ignores unknown ids, the selection does not change
+	assert not client.set_track('Audio', 7)
+	assert server.selected == 3
+
+
+def test_closed_connection_is_dropped(client):
+	FakeRC(client.rc_addr)
+	with pytest.raises(OSError):
+		client.rc('quit')
+	assert client.rc_sock is None
+
+
+def test_stream_ids_fall_back_to_http_status(client):
+	# nothing listens on the RC socket, the ids come from the last HTTP status
+	client.process_alive = lambda: False
+	client.last_status_text = ('<root><information><category name="Stream 0"><info name="Type">Video</info></category>'
+	                           '<category name="Stream 1"><info name="Type">Audio</info></category></information></root>')
+	assert client.stream_ids('Audio') == [1]
+	assert client.selected_track('Audio') is None
+	assert not client.set_track('Audio', 1)
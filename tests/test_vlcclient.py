@@ -0,0 +1,58 @@
+import os, sys
+from types import SimpleNamespace
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+pytest.importorskip('requests')
+from lib.vlcclient import VLCClient, VLCStatus
+
+
+def status_xml(state, title = 'Song', filename = 'song.mp4', volume = 256):
+	streams = '' if state == 'stopped' else \
+		"<category name='Stream 0'><info name='Type'>Video</info></category><category name='Stream 1'><info name='Type'>Audio</info></category>"
+	meta = '' if state == 'stopped' else f"<category name='meta'><info name='title'>{title}</info><info name='filename'>{filename}</info></category>"
+	return f"<?xml version=\"1.0\" encoding=\"utf-8\" standalone=\"yes\" ?>\n<root><volume>{volume}</volume><state>{state}</state>" \
+	       f"<time>3</time><length>200</length><information>{meta}{streams}</information></root>"
+
+
+def test_control_characters_in_meta():
+	st = VLCStatus(status_xml('playing', title = 'Bad\x01Tag'))
+	assert st.state == 'playing' and st.volume == 256
+	assert st.has_video and st.has_audio
+	assert st.filename == 'song.mp4'
+	assert st.categories['meta']['title'] == 'BadTag'
+
+
+def test_malformed_meta_keeps_streams_and_filename():
+	st = VLCStatus(status_xml('playing', title = 'Rock & Roll <live'))
+	assert st.state == 'playing' and st.length == 200
+	assert st.has_video and st.has_audio
+	assert st.filename == 'song.mp4'
+
+
+class FakeVLC:
+	"""status.xml of a standby VLC, in_play starts a song"""
+	def __init__(self):
+		self.state, self.volume = 'stopped', 256
+
+	def get(self, url, timeout = None):
+		cmd = url.partition('?command=')[2]
+		if cmd.startswith('in_play'):
+			self.state = 'playing'
+		elif cmd.startswith('volume&val='):
+			self.volume = int(cmd.partition('=')[2])
+		return SimpleNamespace(status_code = 200, text = status_xml(self.state, volume = self.volume))
+
+	def close(self):
+		pass
+
+
+def test_standby_is_running_right_after_play_file(monkeypatch):
+	monkeypatch.setattr(os, 'K', SimpleNamespace(has_video = False, now_playing = 'Song', is_paused = False), raising = False)
+	k = VLCClient(port = 5999, standby = True)
+	k.session, k.process = FakeVLC(), SimpleNamespace(poll = lambda: None)
+	# the status cache was refreshed between songs and shows the stopped standby player
+	assert not k.is_running()
+	assert k.play_file('/songs/song.mp4', 100)
+	assert k.is_running()
+	assert k.get_status_info().volume == 100
@@ -2,15 +2,17 @@
 
 import os, sys, time, shutil
 import argparse, requests, subprocess
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import numpy as np
-import soundfile as sf
 import torch
 from tqdm import tqdm
 
 from lib import dataset
 from lib import nets
 from lib import spec_utils
+from lib.vocaljobs import VocalJobQueue, missing_outputs, output_name, partial_paths, write_progress, BACKFILL
 import librosa
 
 
@@ -36,30 +38,34 @@ class Separator(object):
 		return y_spec, v_spec
 
 	def _separate(self, X_spec_pad, roi_size):
-		X_dataset = []
 		patches = (X_spec_pad.shape[2] - 2 * self.offset) // roi_size
-		for i in range(patches):
-			start = i * roi_size
-			X_spec_crop = X_spec_pad[:, :, start:start + self.cropsize]
-			X_dataset.append(X_spec_crop)
+		# crop i is X_spec_pad[:, :, i * roi_size:i * roi_size + cropsize], as strided views instead of copies of the song
+		crops = np.lib.stride_tricks.sliding_window_view(X_spec_pad, self.cropsize, axis=2)[:, :, ::roi_size][:, :, :patches]
+		crops = crops.transpose(2, 0, 1, 3)
 
-		X_dataset = np.asarray(X_dataset)
+		# each batch is gathered into the same (pinned, for CUDA) buffer, masks go straight into their place in the output
+		batch = torch.from_numpy(np.empty((self.batchsize,) + crops.shape[1:], dtype=X_spec_pad.dtype))
+		if self.device is not None and torch.device(self.device).type == 'cuda':
+			batch = batch.pin_memory()
+		batch_np = batch.numpy()
+		mask = None
 
 		self.model.eval()
 		with torch.no_grad():
-			mask_list = []
 			# To reduce the overhead, dataloader is not used.
 			for i in tqdm(range(0, patches, self.batchsize)):
-				X_batch = X_dataset[i: i + self.batchsize]
-				X_batch = torch.from_numpy(X_batch).to(self.device)
+				n = min(self.batchsize, patches - i)
+				np.copyto(batch_np[:n], crops[i: i + n])
+				X_batch = batch[:n].to(self.device, non_blocking=True)
 
-				mask = self.model.predict_mask(X_batch)
+				pred = self.model.predict_mask(X_batch)
 
-				mask = mask.detach().cpu().numpy()
-				mask = np.concatenate(mask, axis=2)
-				mask_list.append(mask)
-
-			mask = np.concatenate(mask_list, axis=2)
+				# .cpu() waits for the GPU, so the buffer is free to be refilled for the next batch
+				pred = pred.detach().cpu().numpy()
+				if mask is None:
+					mask = np.empty(X_spec_pad.shape[:2] + (patches * roi_size,), dtype=pred.dtype)
+				for j in range(n):
+					mask[:, :, (i + j) * roi_size:(i + j + 1) * roi_size] = pred[j]
 
 		return mask
 
@@ -76,6 +82,30 @@ class Separator(object):
 
 		return y_spec, v_spec
 
+	def separate_stream(self, X_blocks, peak):
+		"""Yield (X, mask) for a stream of spectrogram blocks, with the same crops as separate()
+
+		Each crop sees `offset` frames of context on either side of its roi, frames are only kept
+		until the crops that need them have run. peak is np.abs(X_spec).max() of the whole song.
+		"""
+		_, _, roi_size = dataset.make_padding(0, self.cropsize, self.offset)
+		buf = None
+		for X in X_blocks:
+			if buf is None:
+				buf = np.zeros(X.shape[:2] + (self.offset,), dtype = X.dtype)
+			buf = np.concatenate([buf, X], axis = 2)
+			patches = (buf.shape[2] - 2 * self.offset) // roi_size
+			if patches > 0:
+				width = patches * roi_size
+				mask = self._separate(buf[:, :, :width + 2 * self.offset] / peak, roi_size)
+				yield buf[:, :, self.offset:self.offset + width], mask
+				buf = buf[:, :, width:]
+		if buf is not None and buf.shape[2] > self.offset:
+			n_frame = buf.shape[2] - self.offset
+			pad_l, pad_r, _ = dataset.make_padding(n_frame, self.cropsize, self.offset)
+			mask = self._separate(np.pad(buf, ((0, 0), (0, 0), (0, pad_r))) / peak, roi_size)
+			yield buf[:, :, self.offset:], mask[:, :, :n_frame]
+
 	def separate_tta(self, X_spec):
 		n_frame = X_spec.shape[2]
 		pad_l, pad_r, roi_size = dataset.make_padding(n_frame, self.cropsize, self.offset)
@@ -98,41 +128,127 @@ class Separator(object):
 		return y_spec, v_spec
 
 
-def ffm_wav2m4a(input_fn, output_fn, br = '128k'):
-	input_fn, output_fn = [fn.replace('"', '\\"') for fn in [input_fn, output_fn]]
-	subprocess.run(['ffmpeg', '-y', '-i', input_fn, '-c:a', 'aac', '-b:a', br, output_fn])
+def stft_stream(blocks, n_fft, hop_length):
+	"""STFT of a stream of (2, n) sample blocks, frame for frame the same as librosa.stft with zero center padding"""
+	def frames(buf):
+		n = (buf.shape[1] - n_fft) // hop_length + 1 if buf.shape[1] >= n_fft else 0
+		if n <= 0:
+			return None, buf
+		used = (n - 1) * hop_length + n_fft
+		spec = np.asarray([librosa.stft(np.ascontiguousarray(ch[:used]), n_fft = n_fft, hop_length = hop_length, center = False) for ch in buf])
+		return spec, buf[:, n * hop_length:]
+
+	buf = np.zeros((2, n_fft // 2), dtype = np.float32)
+	for block in blocks:
+		spec, buf = frames(np.concatenate([buf, block], axis = 1))
+		if spec is not None:
+			yield spec
+	spec, _ = frames(np.pad(buf, ((0, 0), (0, n_fft // 2))))
+	if spec is not None:
+		yield spec
+
+
+class ISTFTStream(object):
+	"""Overlap-add inverse of stft_stream, the same samples as librosa.istft without holding the whole song"""
+
+	def __init__(self, n_fft, hop_length):
+		self.n_fft = n_fft
+		self.hop_length = hop_length
+		self.window = librosa.filters.get_window('hann', n_fft, fftbins = True).astype(np.float32)
+		self.tail = np.zeros((2, n_fft - hop_length), dtype = np.float32)
+		self.tail_norm = np.zeros(n_fft - hop_length, dtype = np.float32)
+		self.skip = n_fft // 2    # center padding
+		self.emitted = 0
+
+	def push(self, spec):
+		n_frame, hop = spec.shape[2], self.hop_length
+		frames = np.fft.irfft(spec, n = self.n_fft, axis = 1).astype(np.float32) * self.window[:, None]
+		wave = np.zeros((2, (n_frame - 1) * hop + self.n_fft), dtype = np.float32)
+		norm = np.zeros(wave.shape[1], dtype = np.float32)
+		wave[:, :self.tail.shape[1]] += self.tail
+		norm[:self.tail.shape[1]] += self.tail_norm
+		window_sq = self.window ** 2
+		for t in range(n_frame):
+			wave[:, t * hop:t * hop + self.n_fft] += frames[:, :, t]
+			norm[t * hop:t * hop + self.n_fft] += window_sq
+		# samples before the next frame's start are final
+		n = n_frame * hop
+		self.tail, self.tail_norm = wave[:, n:], norm[n:]
+		return self._emit(wave[:, :n], norm[:n])
+
+	def flush(self, length):
+		return self._emit(self.tail, self.tail_norm, length)
+
+	def _emit(self, wave, norm, length = None):
+		wave = np.divide(wave, norm, out = wave.copy(), where = norm > np.finfo(np.float32).tiny)
+		drop = min(self.skip, wave.shape[1])
+		self.skip -= drop
+		wave = wave[:, drop:]
+		if length is not None:
+			wave = wave[:, :max(0, length - self.emitted)]
+		self.emitted += wave.shape[1]
+		return wave
+
+
+def ffm_pcm_command(input_fn, sr):
+	# The built-in DNN model is trained on 44100 sampling rate, it can still run but does not work on other sampling rates
+	return ['ffmpeg', '-nostdin', '-v', 'error', '-i', input_fn, '-vn', '-ac', '2', '-ar', str(sr), '-f', 'f32le', '-acodec', 'pcm_f32le', '-']
 
 
-def ffm_video2wav(input_fn, output_fn):
-	# The built-in DNN model is trained on 44100 sampling rate, it can still run but does not work on other sampling rates
-	input_fn, output_fn = [fn.replace('"', '\\"') for fn in [input_fn, output_fn]]
-	subprocess.run(['ffmpeg', '-y', '-i', input_fn, '-f', 'wav', '-ar', '44100', output_fn])
+def ffm_decode_pcm(input_fn, sr = 44100):
+	"""Stereo float32 samples of shape (2, n) decoded and resampled by ffmpeg, read straight from its stdout"""
+	cmd = ffm_pcm_command(input_fn, sr)
+	ret = subprocess.run(cmd, stdin = subprocess.DEVNULL, capture_output = True)
+	if ret.returncode != 0:
+		raise subprocess.CalledProcessError(ret.returncode, cmd, stderr = ret.stderr)
+	return np.frombuffer(ret.stdout, dtype = np.float32).reshape(-1, 2).T, sr
 
 
-def split_vocal_by_stereo(in_wav, out_wav_nonvocal, out_wav_vocal):
+def ffm_pcm_blocks(input_fn, sr, block):
+	"""Like ffm_decode_pcm, but yields blocks of up to `block` samples as ffmpeg decodes them"""
+	cmd = ffm_pcm_command(input_fn, sr)
+	proc = subprocess.Popen(cmd, stdin = subprocess.DEVNULL, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL)
 	try:
-		# Create temporary filenames if not done yet
-		X, sr = librosa.load(in_wav, sr=44100, mono=False, dtype = np.float32, res_type = 'kaiser_fast')
-		if X.shape[0] < 2:
-			return False
-		if out_wav_nonvocal:
-			sf.write(out_wav_nonvocal, X[0, :] - X[1, :], sr)
-		if out_wav_vocal:
-			sf.write(out_wav_vocal, X[0, :] + X[1, :], sr)
-		return True
-	except:
-		return False
+		while True:
+			data = proc.stdout.read(block * 8)
+			data = data[:len(data) // 8 * 8]
+			if not data:
+				break
+			yield np.frombuffer(data, dtype = np.float32).reshape(-1, 2).T
+		if proc.wait() != 0:
+			raise subprocess.CalledProcessError(proc.returncode, cmd)
+	finally:
+		if proc.poll() is None:
+			proc.kill()
+			proc.wait()
+
+
+def ffm_aac_encoder(sr, channels, output_fn, br = '128k'):
+	# an ffmpeg process encoding interleaved float samples written to its stdin
+	cmd = ['ffmpeg', '-y', '-v', 'error', '-f', 'f32le', '-ar', str(sr), '-ac', str(channels), '-i', '-', '-c:a', 'aac', '-b:a', br, output_fn]
+	return subprocess.Popen(cmd, stdin = subprocess.PIPE)
+
+
+def ffm_pcm2m4a(wave, sr, output_fn, br = '128k'):
+	"""Encode float samples of shape (n,) or (n, channels) to AAC, fed to ffmpeg's stdin"""
+	wave = np.ascontiguousarray(wave, dtype = np.float32)
+	proc = ffm_aac_encoder(sr, 1 if wave.ndim == 1 else wave.shape[1], output_fn, br)
+	try:
+		proc.stdin.write(memoryview(wave).cast('B'))
+	finally:
+		proc.stdin.close()
+	if proc.wait() != 0:
+		raise subprocess.CalledProcessError(proc.returncode, proc.args)
 
 
-def split_vocal_by_dnn(in_wav, out_wav_nonvocal, out_wav_vocal, args):
-	print('Loading wave source ...', end = ' ', flush = True)
-	X, sr = librosa.load(in_wav, sr=args.sr, mono=False, dtype = np.float32, res_type = 'kaiser_fast')
-	print('done', flush = True)
+def split_vocal_by_stereo(X):
+	# (nonvocal, vocal) waves by stereo subtraction, None for mono sources (upmixed to identical channels)
+	if np.array_equal(X[0], X[1]):
+		return None
+	return X[0, :] - X[1, :], X[0, :] + X[1, :]
 
-	if X.ndim == 1:
-		# mono to stereo
-		X = np.asarray([X, X])
 
+def split_vocal_by_dnn(X, args, vocal = True):
 	print('STFT of wave source ...', end = ' ', flush = True)
 	X_spec = spec_utils.wave_to_spectrogram(X, args.hop_length, args.n_fft)
 	print('done', flush = True)
@@ -145,55 +261,150 @@ def split_vocal_by_dnn(in_wav, out_wav_nonvocal, out_wav_vocal, args):
 		y_spec, v_spec = sp.separate(X_spec)
 
 	print('Inverse STFT of instruments ...', end = ' ', flush = True)
-	wave = spec_utils.spectrogram_to_wave(y_spec, hop_length = args.hop_length)
+	wave = spec_utils.spectrogram_to_wave(y_spec, hop_length = args.hop_length).T
 	print('done', flush = True)
-	sf.write(out_wav_nonvocal, wave.T, sr)
 
-	if out_wav_vocal:
+	wave_vocal = None
+	if vocal:
 		print('Inverse STFT of vocals ...', end = ' ', flush = True)
-		wave = spec_utils.spectrogram_to_wave(v_spec, hop_length = args.hop_length)
+		wave_vocal = spec_utils.spectrogram_to_wave(v_spec, hop_length = args.hop_length).T
 		print('done', flush = True)
-		sf.write(out_wav_vocal, wave.T, sr)
+	return wave, wave_vocal
+
+
+def ffm_duration(input_fn):
+	out = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'default=nw=1:nk=1', input_fn],
+	                     stdin = subprocess.DEVNULL, capture_output = True, text = True).stdout
+	try:
+		return float(out)
+	except ValueError:
+		return None
+
+
+def split_vocal_streaming(input_fn, tracks, args):
+	"""Separate with the DNN in blocks of args.stream_sec seconds, peak memory does not depend on the song length
+
+	tracks maps 'nonvocal'/'vocal' to their final .m4a. A first decoding pass finds the spectrogram peak that
+	separate() normalises by, the second pass is separated and encoded while ffmpeg decodes it. It goes to
+	growing .partial.aac (ADTS) files with a progress sidecar, so that PiKaraoke can play a track before it is
+	done, and is remuxed into the final .m4a at the end.
+	"""
+	sr, n_fft, hop_length = args.sr, args.n_fft, args.hop_length
+	block = max(int(args.stream_sec * sr), n_fft)
+	duration = ffm_duration(input_fn)
+	print('Finding peak of wave source ...', end = ' ', flush = True)
+	peak = max((float(np.abs(X).max()) for X in stft_stream(ffm_pcm_blocks(input_fn, sr, block), n_fft, hop_length)), default = 0.0)
+	print('done', flush = True)
+
+	n_sample = 0
+	def counted(blocks):
+		nonlocal n_sample
+		for b in blocks:
+			n_sample += b.shape[1]
+			yield b
+
+	sp = Separator(args.model, args.device, args.batchsize, args.cropsize)
+	partials = {kind: partial_paths(track) for kind, track in tracks.items()}
+	encoders = {kind: ffm_aac_encoder(sr, 2, partial) for kind, (partial, _) in partials.items()}
+	istft = {kind: ISTFTStream(n_fft, hop_length) for kind in encoders}
+	started = updated = time.time()
+	try:
+		X_blocks = stft_stream(counted(ffm_pcm_blocks(input_fn, sr, block)), n_fft, hop_length)
+		for X, mask in sp.separate_stream(X_blocks, peak or 1.0):
+			y_spec = X * mask
+			specs = {'nonvocal': y_spec, 'vocal': X - y_spec}
+			for kind, proc in encoders.items():
+				wave = istft[kind].push(specs[kind])
+				proc.stdin.write(np.ascontiguousarray(wave.T))
+				proc.stdin.flush()
+			now = time.time()
+			for kind, (_, sidecar) in partials.items():
+				write_progress(sidecar, seconds = istft[kind].emitted / sr, duration = duration,
+				               started = started, updated = now, interval = now - updated)
+			updated = now
+		for kind, proc in encoders.items():
+			proc.stdin.write(np.ascontiguousarray(istft[kind].flush(n_sample).T))
+			proc.stdin.close()
+			if proc.wait() != 0:
+				raise subprocess.CalledProcessError(proc.returncode, proc.args)
+		for kind, (partial, sidecar) in partials.items():
+			m4a = partial[:-4] + '.m4a'
+			subprocess.run(['ffmpeg', '-y', '-v', 'error', '-i', partial, '-c', 'copy', m4a], stdin = subprocess.DEVNULL, check = True)
+			os.replace(m4a, tracks[kind])
+	finally:
+		for proc in encoders.values():
+			if proc.poll() is None:
+				proc.kill()
+				proc.wait()
+		# the sidecar goes first, a partial still open in VLC cannot be removed on Windows
+		for partial, sidecar in partials.values():
+			for fn in [sidecar, partial, partial[:-4] + '.m4a']:
+				try:
+					os.remove(fn)
+				except OSError:
+					pass
+
+
+def stream_stage(next_file, dnn, args):
+	# decoding, separation and encoding at once, instead of the three pipeline stages
+	tracks = {kind: f'{song_path}/{kind}/{output_name(next_file, dnn)}' for kind in ['nonvocal', 'vocal'] if os.path.isdir(f'{song_path}/{kind}')}
+	split_vocal_streaming(song_path+'/'+next_file, tracks, args)
+
+
+def encode_stage(next_file, dnn, waves, sr, tag):
+	# runs in the encode pool, the temporary .m4a is on the same filesystem as its target for the move
+	for kind, wave in zip(['nonvocal', 'vocal'], waves):
+		if wave is None or not os.path.isdir(f'{song_path}/{kind}'):
+			continue
+		m4a = f'{song_path}/.{tag}.{kind}.m4a'
+		try:
+			ffm_pcm2m4a(wave, sr, m4a)
+			shutil.move(m4a, f'{song_path}/{kind}/{output_name(next_file, dnn)}')
+		finally:
+			if os.path.isfile(m4a):
+				os.remove(m4a)
 
 
 song_path = ''
-last_completed = ''
 use_DNN = True
 
-def get_next_file(cuda_device):
-	global song_path, use_DNN, last_completed
+def connect(cuda_device):
+	"""Get the download path and splitting mode from PiKaraoke, False if it is not running"""
+	global song_path, use_DNN
 	try:
-		obj = requests.get(f'http://localhost:5000/get_vocal_todo_list/{cuda_device.type}/{last_completed}').json()
+		obj = requests.get(f'http://localhost:5000/get_vocal_todo_list/{cuda_device.type}/').json()
 		song_path = obj['download_path'].rstrip('/')
 		use_DNN = obj['use_DNN']
+		return True
 	except:
 		if not song_path:
 			print('PiKaraoke is not running and --download-path is not specified, exiting ...')
 			sys.exit()
-		obj = {'queue': []}
+		return False
 
-	if not os.path.isdir(song_path+'/nonvocal') and not os.path.isdir(song_path+'/vocal'):
-		return None
-	for fn in obj['queue']:
-		bn = ('' if use_DNN else '.')+os.path.basename(fn)
-		if os.path.isdir(song_path+'/nonvocal') and not os.path.isfile(f'{song_path}/nonvocal/{bn}.m4a'):
-			return os.path.basename(fn)
-		if os.path.isdir(song_path+'/vocal') and not os.path.isfile(f'{song_path}/vocal/{bn}.m4a'):
-			return os.path.basename(fn)
 
-	# get from listing directory
-	for bn in [i for i in os.listdir(song_path) if not i.startswith('.') and os.path.isfile(song_path+'/'+i)]:
-		bn1 = ('' if use_DNN else '.')+bn
-		if os.path.isdir(song_path+'/nonvocal') and not os.path.isfile(f'{song_path}/nonvocal/{bn1}.m4a'):
-			return bn
-		if os.path.isdir(song_path+'/vocal') and not os.path.isfile(f'{song_path}/vocal/{bn1}.m4a'):
-			return bn
+def get_next_file(jobs):
+	# (basename, use_DNN, priority) of the next job worth doing, or None
+	while True:
+		job = jobs.claim()
+		if job is None:
+			return None
+		bn, dnn, _ = job
+		# the song may have been deleted, or split already, since the job was pushed
+		if os.path.isfile(song_path+'/'+bn) and missing_outputs(song_path, [bn], dnn):
+			return job
+		jobs.done(bn, dnn)
+
 
-	return None
+def report_done(cuda_device, bn):
+	try:
+		requests.get(f'http://localhost:5000/vocal_job_done/{cuda_device.type}/{quote(bn)}', timeout = 5)
+	except:
+		pass
 
 
 def main(argv):
-	global song_path, last_completed
+	global song_path
 
 	p = argparse.ArgumentParser()
 	p.add_argument('--download-path', '-d', help = "Path for downloaded songs. Will be overridden by the one from HTTP request. "
@@ -207,9 +418,19 @@ def main(argv):
 	p.add_argument('--cropsize', '-c', type = int, default = 256)
 	p.add_argument('--postprocess', '-p', action = 'store_true')
 	p.add_argument('--tta', '-t', action = 'store_true')
-	p.add_argument('--ramdir', '-rd', help = 'Temporary directory on RAMDISK to reduce I/O load',
-	               default = 'z:/' if sys.platform.startswith('win') else '/dev/shm')
+	p.add_argument('--ramdir', '-rd', help = 'Deprecated and ignored, audio is piped through ffmpeg without temporary .wav files')
+	p.add_argument('--encoders', '-e', type = int, default = 2, help = 'Number of songs being encoded to AAC while the next one is separated')
+	p.add_argument('--stream-sec', '-s', type = float, default = 30,
+	               help = 'Separate playing and queued songs with the DNN in blocks of this many seconds, so that their tracks can be played '
+	                      'while they are being separated and memory use does not grow with the song length. Library backfill jobs are '
+	                      'separated whole, overlapped with decoding and encoding, unless longer than --whole-max-sec '
+	                      '(0: whole songs only, always the case with --tta)')
+	p.add_argument('--whole-max-sec', '-W', type = float, default = 900, help = 'Library songs longer than this are streamed too, to bound memory use')
+	p.add_argument('--sequential', '-S', action = 'store_true',
+	               help = 'Decode, separate and encode one song at a time instead of overlapping them, for comparing throughput')
 	args = p.parse_args(argv)
+	if args.ramdir is not None:
+		print('Warning: --ramdir is deprecated, audio is piped through ffmpeg without temporary .wav files, ignored!', flush = True)
 
 	song_path = os.path.expanduser(args.download_path).rstrip('/')
 
@@ -226,43 +447,90 @@ def main(argv):
 	print('done', flush = True)
 
 	# set song_path global variable from local server
-	get_next_file(device)
-
-	# Use RAMDISK for large temporary .wav files for speed up if available
-	RAMDIR = args.ramdir if os.path.isdir(args.ramdir) else song_path
-
-	# Create temporary filenames if not done yet
-	in_wav, out_wav_vocal, out_wav_nonvocal, out_m4a_vocal, out_m4a_nonvocal = \
-		[f'{RAMDIR}/.input.wav', f'{RAMDIR}/.vocal.wav', f'{RAMDIR}/.nonvocal.wav', f'{song_path}/.vocal.m4a', f'{song_path}/.nonvocal.m4a']
+	server = connect(device)
+
+	# PiKaraoke pushes jobs as songs are queued or added, standalone runs backfill the library once
+	# the same file as Karaoke.state_file('vocal_jobs.db'), kept out of the scanned download path
+	os.makedirs(song_path+'/.state', exist_ok = True)
+	jobs = VocalJobQueue(song_path+'/.state/vocal_jobs.db')
+	jobs.listen()
+	jobs.reset_running()
+	if not server:
+		songs = [i for i in os.listdir(song_path) if not i.startswith('.') and os.path.isfile(song_path+'/'+i)]
+		jobs.push(missing_outputs(song_path, songs, use_DNN), BACKFILL, use_DNN)
+
+	# Pipeline: song N+1 is decoded and song N-1 encoded while song N is separated, PCM is piped to/from ffmpeg
+	n_encoders = max(1, args.encoders)
+	decoder, encoder = ThreadPoolExecutor(1), ThreadPoolExecutor(n_encoders)
+	seq, encoding, n_done, busy_since = 0, set(), 0, None
+	streaming = args.stream_sec > 0 and not args.tta
+
+	def start_next():
+		nonlocal seq
+		job = get_next_file(jobs)
+		if job is None:
+			return None
+		seq += 1
+		bn, dnn, priority = job
+		# streaming gives a playing or queued song its partial tracks early, the library backfill is pipelined for throughput
+		# unless the song is too long to be held in memory at once
+		if dnn and streaming and (priority < BACKFILL or (ffm_duration(song_path+'/'+bn) or float('inf')) > args.whole_max_sec):
+			return (bn, dnn, f'split-{os.getpid()}-{seq}', None)
+		return (bn, dnn, f'split-{os.getpid()}-{seq}', decoder.submit(ffm_decode_pcm, song_path+'/'+bn, args.sr if dnn else 44100))
+
+	def finish(next_file, dnn, stage, *stage_args):
+		nonlocal n_done
+		try:
+			stage(next_file, dnn, *stage_args)
+			n_done += 1
+			print(f'Finished {next_file}', flush = True)
+		except Exception as e:
+			print(f'Processing {next_file} failed: {e}', flush = True)
+		jobs.done(next_file, dnn)
+		report_done(device, next_file)
 
 	# Main loop
+	pending = None
 	while True:
-		next_file = get_next_file(device)
-		if not next_file:
-			time.sleep(2)
+		if pending is None:
+			pending = start_next()
+		if pending is None:
+			wait(encoding)
+			if busy_since is not None and n_done:
+				elapsed = time.time()-busy_since
+				print(f'Processed {n_done} songs in {elapsed:.0f}s, {n_done*3600/elapsed:.1f} songs/hour'
+				      f' ({"sequential" if args.sequential else "pipelined"})', flush = True)
+			busy_since, n_done = None, 0
+			jobs.wait(60)
 			continue
+		busy_since = busy_since or time.time()
+
+		next_file, dnn, tag, decoding = pending
+		pending = None if args.sequential else start_next()
 
 		# run vocal splitter on next_file
 		print(f'Start processing {next_file} :')
-		ffm_video2wav(song_path+'/'+next_file, in_wav)
-
-		if use_DNN:
-			split_vocal_by_dnn(in_wav, out_wav_nonvocal, out_wav_vocal, args)
-			if os.path.isdir(song_path+'/nonvocal'):
-				ffm_wav2m4a(out_wav_nonvocal, out_m4a_nonvocal)
-				shutil.move(out_m4a_nonvocal, f'{song_path}/nonvocal/{next_file}.m4a')
-			if os.path.isdir(song_path+'/vocal'):
-				ffm_wav2m4a(out_wav_vocal, out_m4a_vocal)
-				shutil.move(out_m4a_vocal, f'{song_path}/vocal/{next_file}.m4a')
-		else:
-			split_vocal_by_stereo(in_wav, out_wav_nonvocal, out_wav_vocal)
-			if os.path.isdir(song_path+'/nonvocal'):
-				ffm_wav2m4a(out_wav_nonvocal, out_m4a_nonvocal)
-				shutil.move(out_m4a_nonvocal, f'{song_path}/nonvocal/.{next_file}.m4a')
-			if os.path.isdir(song_path+'/vocal'):
-				ffm_wav2m4a(out_wav_vocal, out_m4a_vocal)
-				shutil.move(out_m4a_vocal, f'{song_path}/vocal/.{next_file}.m4a')
-		last_completed = next_file
+		if decoding is None:
+			finish(next_file, dnn, stream_stage, args)
+			continue
+		try:
+			X, sr = decoding.result()
+			waves = split_vocal_by_dnn(X, args, os.path.isdir(song_path+'/vocal')) if dnn else split_vocal_by_stereo(X)
+		except Exception as e:
+			print(f'Separating {next_file} failed: {e}', flush = True)
+			waves = None
+		if waves is None:
+			jobs.done(next_file, dnn)
+			continue
+
+		# each queued encode holds the separated waves of a whole song, wait for a free encoder instead of piling them up
+		encoding = {f for f in encoding if not f.done()}
+		while len(encoding) >= n_encoders:
+			done, encoding = wait(encoding, return_when = FIRST_COMPLETED)
+		future = encoder.submit(finish, next_file, dnn, encode_stage, waves, sr, tag)
+		encoding.add(future)
+		if args.sequential:
+			wait([future])
 
 
 if __name__ == '__main__':